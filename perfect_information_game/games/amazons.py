@@ -34,6 +34,7 @@ class Amazons(Game):
     REPRESENTATION_FILES = ['dark_square', 'white_circle_dark_square',
                             'black_circle_dark_square', 'red_circle_dark_square']
     CLICKS_PER_MOVE = 3
+    LOSES_WITHOUT_MOVES = True
 
     def __init__(self, state=STARTING_STATE):
         super().__init__(state)
@@ -29,6 +29,7 @@ class Checkers(Game):
     MOVE_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
     REPRESENTATION_LETTERS = ['r', 'R', 'b', 'B']
     CLICKS_PER_MOVE = 2
+    LOSES_WITHOUT_MOVES = True
     REPRESENTATION_FILES = ['dark_square', 'red_circle_dark_square', 'red_circle_k_dark_square',
                             'black_circle_dark_square', 'black_circle_k_dark_square']
 
@@ -1,6 +1,7 @@
 from perfect_information_game.games import Game
 import numpy as np
-from perfect_information_game.utils import one_hot, iter_product, STRAIGHT_DIRECTIONS, DIAGONAL_DIRECTIONS, DIRECTIONS_8
+from perfect_information_game.utils import one_hot, iter_product, get_rng, STRAIGHT_DIRECTIONS, DIAGONAL_DIRECTIONS, \
+    DIRECTIONS_8
 from functools import partial
 import easygui
 
@@ -617,6 +618,15 @@ class Chess(Game):
     def is_draw_by_insufficient_material(cls, state):
         return cls.get_position_descriptor(state) in cls.DRAWING_DESCRIPTORS
 
+    @classmethod
+    def step_random(cls, state, moves=None, rng=None):
+        moves = cls.get_possible_moves(state) if moves is None else moves
+        next_state = moves[(get_rng() if rng is None else rng).integers(len(moves))]
+        # checking whether the game is over requires the moves of the next state, so reuse them in the next step
+        next_moves = cls.get_possible_moves(next_state)
+        winner = cls.get_winner(next_state, next_moves) if cls.is_over(next_state, next_moves) else None
+        return next_state, next_moves, winner
+
     @classmethod
     def is_over(cls, state, moves=None):
         return cls.is_draw_by_insufficient_material(state) or \
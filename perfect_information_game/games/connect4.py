@@ -1,8 +1,94 @@
 from perfect_information_game.games import Game
 import numpy as np
+from numba import njit
 from perfect_information_game.utils import iter_product
 
 
+@njit(cache=True, nogil=True)
+def _check_win_bitboard(pieces):
+    # bit j * 7 + h represents column j at height h from the bottom, and the 7th bit of each column is always empty
+    # so that shifts by 1 (vertical), 7 (horizontal), 6 and 8 (diagonals) never wrap around the board
+    for shift in (1, 7, 6, 8):
+        pairs = pieces & (pieces >> shift)
+        if pairs & (pairs >> (2 * shift)):
+            return True
+    return False
+
+
+# status returned by _step_random while the game is not over, the other statuses are the winners 1, 0 and -1
+_ONGOING = 2
+
+
+@njit(cache=True, nogil=True)
+def _step_random(player_1_pieces, player_2_pieces, is_player_1_turn):
+    """
+    Plays a random move, and checks whether the game is over in the same pass.
+
+    :return: The next player_1_pieces, player_2_pieces, is_player_1_turn, and the status of the game.
+    """
+    combined_pieces = player_1_pieces | player_2_pieces
+    columns = np.empty(7, dtype=np.int64)
+    column_count = 0
+    for j in range(7):
+        if not combined_pieces & (1 << (j * 7 + 5)):
+            columns[column_count] = j
+            column_count += 1
+    if column_count == 0:
+        return player_1_pieces, player_2_pieces, is_player_1_turn, 0
+
+    j = columns[np.random.randint(column_count)]
+    # pieces in a column are contiguous from the bottom, so adding 1 gives the lowest empty square
+    move = (((combined_pieces >> (j * 7)) & 0x3F) + 1) << (j * 7)
+    status = _ONGOING
+    if is_player_1_turn:
+        player_1_pieces |= move
+        if _check_win_bitboard(player_1_pieces):
+            status = 1
+    else:
+        player_2_pieces |= move
+        if _check_win_bitboard(player_2_pieces):
+            status = -1
+    return player_1_pieces, player_2_pieces, not is_player_1_turn, status
+
+
+@njit(cache=True, nogil=True)
+def _random_game(player_1_pieces, player_2_pieces, is_player_1_turn):
+    if _check_win_bitboard(player_1_pieces):
+        return 1
+    if _check_win_bitboard(player_2_pieces):
+        return -1
+
+    status = _ONGOING
+    while status == _ONGOING:
+        player_1_pieces, player_2_pieces, is_player_1_turn, status = _step_random(player_1_pieces, player_2_pieces,
+                                                                                  is_player_1_turn)
+    return status
+
+
+@njit(cache=True, nogil=True)
+def _to_bitboards(state):
+    player_1_pieces = 0
+    player_2_pieces = 0
+    for i in range(6):
+        for j in range(7):
+            bit = 1 << (j * 7 + 5 - i)
+            if state[i, j, 0] == 1:
+                player_1_pieces |= bit
+            elif state[i, j, 1] == 1:
+                player_2_pieces |= bit
+    return np.array([player_1_pieces, player_2_pieces, state[0, 0, 2]], dtype=np.int64)
+
+
+@njit(cache=True, nogil=True)
+def _rollout_kernel(state, rollouts):
+    player_1_pieces, player_2_pieces, is_player_1_turn = _to_bitboards(state)
+
+    rollout_sum = 0
+    for _ in range(rollouts):
+        rollout_sum += _random_game(player_1_pieces, player_2_pieces, is_player_1_turn)
+    return rollout_sum
+
+
 class Connect4(Game):
     STARTING_STATE = np.stack([np.zeros((6, 7)), np.zeros((6, 7)), np.ones((6, 7))], axis=-1).astype(np.uint8)
     STATE_SHAPE = STARTING_STATE.shape  # 6, 7, 3
@@ -12,6 +98,8 @@ class Connect4(Game):
     REPRESENTATION_LETTERS = ['y', 'r']
     REPRESENTATION_FILES = ['dark_square', 'yellow_circle_dark_square', 'red_circle_dark_square']
     CLICKS_PER_MOVE = 1
+    ROLLOUT_KERNEL = staticmethod(_rollout_kernel)
+    ROLLOUT_KERNEL_RELEASES_GIL = True
 
     def __init__(self, state=STARTING_STATE):
         super().__init__(state)
@@ -49,6 +137,10 @@ class Connect4(Game):
     def get_legal_moves(cls, state):
         return np.array([np.all(state[0, j, :2] == 0) for j in range(cls.COLUMNS)])
 
+    @classmethod
+    def get_legal_moves_batch(cls, states):
+        return np.all(states[:, 0, :, :2] == 0, axis=-1)
+
     @classmethod
     def check_win(cls, pieces):
         # Check vertical
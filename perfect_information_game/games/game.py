@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 import numpy as np
+from perfect_information_game.utils import get_rng
 
 
 # noinspection PyUnresolvedReferences
@@ -14,6 +15,17 @@ class Game(ABC):
     # REPRESENTATION_FILES = []
     # CLICKS_PER_MOVE = int
 
+    # OPTIONAL CLASS VARIABLES
+    # A compiled or vectorized function (state, rollouts) -> sum of the winners of that many random games played from
+    # state. Games that implement batch_step can use execute_batch_rollouts.
+    ROLLOUT_KERNEL = None
+    # True if ROLLOUT_KERNEL is compiled with nogil=True, so that several calls to it can run in parallel on threads
+    ROLLOUT_KERNEL_RELEASES_GIL = False
+    # True if the game ends exactly when the player to move has no possible moves, in which case they lose
+    LOSES_WITHOUT_MOVES = False
+    # Random 64 bit integers with shape STATE_SHAPE used by zobrist_hash, generated the first time they are needed
+    ZOBRIST_TABLE = None
+
     # INSTANCE FUNCTIONS
 
     def __init__(self, state=None):
@@ -92,6 +104,16 @@ class Game(ABC):
         """
         pass
 
+    @classmethod
+    def get_legal_moves_batch(cls, states):
+        """
+        Games with simple legality rules should override this with a vectorized implementation.
+
+        :param states: The positions with shape (k,) + STATE_SHAPE.
+        :return: A numpy array with shape=(k,) + MOVE_SHAPE containing get_legal_moves for each position.
+        """
+        return np.stack([cls.get_legal_moves(state) for state in states], axis=0)
+
     @classmethod
     @abstractmethod
     def is_over(cls, state):
@@ -105,6 +127,73 @@ class Game(ABC):
         """
         pass
 
+    @classmethod
+    def zobrist_hash(cls, state):
+        """
+        The zobrist table is generated from a fixed seed, so that hashes are consistent across processes.
+
+        :return: A 64 bit integer hash of the given state, formed by xor-ing together the zobrist table entries of every
+                 nonzero feature.
+        """
+        if cls.ZOBRIST_TABLE is None or cls.ZOBRIST_TABLE.shape != state.shape:
+            cls.ZOBRIST_TABLE = np.random.default_rng(0).integers(np.iinfo(np.uint64).max, size=state.shape,
+                                                                  dtype=np.uint64, endpoint=True)
+        return int(np.bitwise_xor.reduce(cls.ZOBRIST_TABLE[state != 0]))
+
+    @classmethod
+    def step_random(cls, state, moves=None, rng=None):
+        """
+        Plays a uniformly random move from the given state, which must not be terminal.
+        Games should override this if checking whether the next state is terminal generates its moves as a side effect,
+        so that the moves don't need to be generated again in the next step. This is already done for games that set
+        LOSES_WITHOUT_MOVES.
+
+        :param moves: get_possible_moves(state), if it has already been computed.
+        :param rng: The np.random.Generator used to choose the move. Defaults to get_rng().
+        :return: A tuple of the next state, get_possible_moves(next_state) or None if it wasn't computed, and the winner of
+                 the next state or None if the game is not over.
+        """
+        moves = cls.get_possible_moves(state) if moves is None else moves
+        next_state = moves[(get_rng() if rng is None else rng).integers(len(moves))]
+        if cls.LOSES_WITHOUT_MOVES:
+            # the game is over when there are no moves, so the moves of the next state are needed to check that anyway
+            next_moves = cls.get_possible_moves(next_state)
+            winner = (-1 if cls.is_player_1_turn(next_state) else 1) if len(next_moves) == 0 else None
+            return next_state, next_moves, winner
+        return next_state, None, cls.get_winner(next_state) if cls.is_over(next_state) else None
+
+    @classmethod
+    def batch_step(cls, states, rng):
+        """
+        Optional vectorized version of step_random, used by execute_batch_rollouts.
+
+        :param states: The positions with shape (k,) + STATE_SHAPE, none of which may be terminal.
+        :param rng: The np.random.Generator used to choose the moves.
+        :return: A tuple of the next states with shape (k,) + STATE_SHAPE, a boolean array with shape (k,) indicating
+                 which next states are terminal, and an int array with shape (k,) containing the winner of each next
+                 state, or 0 if it isn't terminal.
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def execute_batch_rollouts(cls, state, rollouts, rng=None):
+        """
+        Plays all the rollouts in lockstep as a single batch using batch_step, dropping games from the batch as they end.
+
+        :return: The sum of the winners of the rollouts.
+        """
+        if cls.is_over(state):
+            return rollouts * cls.get_winner(state)
+
+        rng = get_rng() if rng is None else rng
+        states = np.repeat(state[np.newaxis, ...], rollouts, axis=0)
+        rollout_sum = 0
+        while len(states) > 0:
+            states, over, winners = cls.batch_step(states, rng)
+            rollout_sum += int(np.sum(winners))
+            states = states[~over]
+        return rollout_sum
+
     @classmethod
     def get_img_index_representation(cls, state):
         """
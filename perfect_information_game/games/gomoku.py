@@ -3,6 +3,10 @@ import numpy as np
 from perfect_information_game.utils import iter_product
 
 
+def _rollout_kernel(state, rollouts):
+    return Gomoku.execute_batch_rollouts(state, rollouts)
+
+
 class Gomoku(Game):
     # TODO: replace TicTacToe, MultiTicTacToe, and Gomoku with a single generalization
     W = 19  # board width
@@ -15,6 +19,9 @@ class Gomoku(Game):
     REPRESENTATION_LETTERS = ['X', 'O']
     CLICKS_PER_MOVE = 1
     REPRESENTATION_FILES = ['dark_square', 'white_circle_dark_square', 'black_circle_dark_square']
+    ROLLOUT_KERNEL = staticmethod(_rollout_kernel)
+    # the kernel is vectorized with numpy over all of its rollouts, so it holds the GIL and is called once per batch
+    ROLLOUT_KERNEL_RELEASES_GIL = False
 
     def __init__(self, state=STARTING_STATE):
         super().__init__(state)
@@ -42,6 +49,10 @@ class Gomoku(Game):
     def get_legal_moves(cls, state):
         return np.array([[np.all(state[i, j, :2] == 0) for j in range(cls.COLUMNS)] for i in range(cls.ROWS)])
 
+    @classmethod
+    def get_legal_moves_batch(cls, states):
+        return np.all(states[..., :2] == 0, axis=-1)
+
     @classmethod
     def is_over(cls, state):
         return cls.check_win(state[:, :, 0]) or cls.check_win(state[:, :, 1]) or cls.is_board_full(state)
@@ -55,6 +66,42 @@ class Gomoku(Game):
         if cls.is_board_full(state):
             return 0
 
+    @classmethod
+    def batch_step(cls, states, rng):
+        batch_size = states.shape[0]
+        batch_indices = np.arange(batch_size)
+        empty_squares = np.all(states[..., :2] == 0, axis=-1).reshape(batch_size, -1)
+        empty_square_counts = np.sum(empty_squares, axis=1)
+
+        # choose a random empty square for each state, by finding the index of the chosen_index-th empty square
+        chosen_indices = rng.integers(0, empty_square_counts)
+        squares = np.argmax(np.cumsum(empty_squares, axis=1) > chosen_indices[:, np.newaxis], axis=1)
+        i, j = np.divmod(squares, cls.COLUMNS)
+
+        is_player_1_turn = states[:, 0, 0, 2] == 1
+        players = np.where(is_player_1_turn, 0, 1)
+        next_states = np.copy(states)
+        next_states[batch_indices, i, j, players] = 1
+        next_states[..., 2] = np.logical_not(is_player_1_turn)[:, np.newaxis, np.newaxis]
+
+        # the states weren't terminal, so only the player who just moved can have won
+        wins = cls.check_win_batch(next_states[batch_indices, :, :, players])
+        over = wins | (empty_square_counts == 1)
+        winners = np.where(wins, np.where(is_player_1_turn, 1, -1), 0)
+        return next_states, over, winners
+
+    @staticmethod
+    def check_win_batch(pieces):
+        """
+        Vectorized version of check_win, where pieces has shape (k,) + BOARD_SHAPE.
+        """
+        vertical = np.ones((pieces.shape[0], Gomoku.W - 5, Gomoku.W), dtype=bool)
+        horizontal = np.ones((pieces.shape[0], Gomoku.W, Gomoku.W - 5), dtype=bool)
+        for k in range(5):
+            vertical &= pieces[:, k:Gomoku.W - 5 + k, :] == 1
+            horizontal &= pieces[:, :, k:Gomoku.W - 5 + k] == 1
+        return np.any(vertical, axis=(1, 2)) | np.any(horizontal, axis=(1, 2))
+
     @staticmethod
     def check_win(pieces):
         # TODO: update this for Gomoku, the rest of the class is properly implemented
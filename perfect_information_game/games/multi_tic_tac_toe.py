@@ -48,6 +48,10 @@ class MultiTicTacToe(Game):
             .reshape(MultiTicTacToe.BOARD_SHAPE)
         # return np.array([[np.all(state[i, j, :2] == 0) for coords in iter_product(MultiTicTacToe.BOARD_SHAPE))
 
+    @classmethod
+    def get_legal_moves_batch(cls, states):
+        return np.all(states[..., :2] == 0, axis=-1)
+
     @classmethod
     def is_over(cls, state):
         return cls.check_win(state[..., 0]) or cls.check_win(state[..., 1]) or cls.is_board_full(state)
@@ -1,8 +1,70 @@
 from perfect_information_game.games import Game
 import numpy as np
+from numba import njit
 from perfect_information_game.utils import iter_product
 
 
+# bit i * 3 + j represents square (i, j), and each mask covers one of the 3 rows, 3 columns, or 2 diagonals
+_WIN_MASKS = np.array([0b000000111, 0b000111000, 0b111000000, 0b001001001, 0b010010010, 0b100100100,
+                       0b100010001, 0b001010100], dtype=np.int64)
+
+
+@njit(cache=True, nogil=True)
+def _check_win_bitboard(pieces):
+    for mask in _WIN_MASKS:
+        if pieces & mask == mask:
+            return True
+    return False
+
+
+@njit(cache=True, nogil=True)
+def _random_game(player_1_pieces, player_2_pieces, is_player_1_turn):
+    if _check_win_bitboard(player_1_pieces):
+        return 1
+    if _check_win_bitboard(player_2_pieces):
+        return -1
+
+    squares = np.empty(9, dtype=np.int64)
+    while True:
+        combined_pieces = player_1_pieces | player_2_pieces
+        square_count = 0
+        for k in range(9):
+            if not combined_pieces & (1 << k):
+                squares[square_count] = k
+                square_count += 1
+        if square_count == 0:
+            return 0
+
+        move = 1 << squares[np.random.randint(square_count)]
+        if is_player_1_turn:
+            player_1_pieces |= move
+            if _check_win_bitboard(player_1_pieces):
+                return 1
+        else:
+            player_2_pieces |= move
+            if _check_win_bitboard(player_2_pieces):
+                return -1
+        is_player_1_turn = not is_player_1_turn
+
+
+@njit(cache=True, nogil=True)
+def _rollout_kernel(state, rollouts):
+    player_1_pieces = 0
+    player_2_pieces = 0
+    for i in range(3):
+        for j in range(3):
+            if state[i, j, 0] == 1:
+                player_1_pieces |= 1 << (i * 3 + j)
+            elif state[i, j, 1] == 1:
+                player_2_pieces |= 1 << (i * 3 + j)
+    is_player_1_turn = state[0, 0, 2] == 1
+
+    rollout_sum = 0
+    for _ in range(rollouts):
+        rollout_sum += _random_game(player_1_pieces, player_2_pieces, is_player_1_turn)
+    return rollout_sum
+
+
 class TicTacToe(Game):
     W = 3
     STARTING_STATE = np.stack([np.zeros((W, W)), np.zeros((W, W)), np.ones((W, W))], axis=-1).astype(np.uint8)
@@ -13,6 +75,8 @@ class TicTacToe(Game):
     REPRESENTATION_LETTERS = ['X', 'O']
     CLICKS_PER_MOVE = 1
     REPRESENTATION_FILES = ['dark_square', 'white_circle_dark_square', 'black_circle_dark_square']
+    ROLLOUT_KERNEL = staticmethod(_rollout_kernel)
+    ROLLOUT_KERNEL_RELEASES_GIL = True
 
     def __init__(self, state=STARTING_STATE):
         super().__init__(state)
@@ -40,6 +104,10 @@ class TicTacToe(Game):
     def get_legal_moves(cls, state):
         return np.array([[np.all(state[i, j, :2] == 0) for j in range(cls.COLUMNS)] for i in range(cls.ROWS)])
 
+    @classmethod
+    def get_legal_moves_batch(cls, states):
+        return np.all(states[..., :2] == 0, axis=-1)
+
     @classmethod
     def is_over(cls, state):
         return cls.check_win(state[:, :, 0]) or cls.check_win(state[:, :, 1]) or cls.is_board_full(state)
@@ -1,4 +1,6 @@
 from time import time
+from math import prod
+import warnings
 import numpy as np
 from perfect_information_game.utils import get_training_path
 
@@ -19,6 +21,10 @@ class Network:
 
         # lazily initialized so Network can be passed between processes before being initialized
         self.model = None
+        self.inference_function = None
+        # persistent input buffers for the inference function, keyed by the batch sizes that it has been compiled for
+        self.input_buffers = {}
+        self.quantized_model = None
 
         self.reinforcement_training = reinforcement_training
         self.hyper_params = hyper_params if hyper_params is not None else {}
@@ -39,7 +45,8 @@ class Network:
         if self.model_path is not None:
             input_shape = self.GameClass.STATE_SHAPE
             output_shape = self.GameClass.MOVE_SHAPE
-            self.model = load_model(self.model_path)
+            # the model is only compiled if it will be trained, because compiling slows down inference
+            self.model = load_model(self.model_path, compile=self.reinforcement_training)
             if self.model.input_shape != (None,) + input_shape:
                 raise Exception('Input shape of loaded model doesn\'t match!')
             if self.model.output_shape != [(None,) + output_shape, (None, 1)]:
@@ -47,6 +54,7 @@ class Network:
             # TODO: recompile model with loss_weights and learning schedule from config file
         else:
             self.model = self.create_model(**self.hyper_params)
+        self.inference_function = self.create_inference_function()
 
         if self.reinforcement_training:
             self.tensor_board = TensorBoard(log_dir=f'{get_training_path(self.GameClass)}/logs/'
@@ -55,59 +63,275 @@ class Network:
             self.tensor_board.set_model(self.model)
 
     def create_model(self, kernel_size=(4, 4), convolutional_filters=64, residual_layers=6,
-                     value_head_neurons=16, policy_loss_value=1):
+                     value_head_neurons=16, policy_loss_value=1, train=True, mixed_precision=False):
         """
         https://www.youtube.com/watch?v=OPgRNY3FaxA
+
+        :param train: If False, the model will not be compiled since it will only be used for inference.
+        :param mixed_precision: If True, the layers will compute in float16 while keeping their weights in float32.
+                                This is much faster on GPUs with tensor cores, especially if convolutional_filters is a
+                                multiple of 8. The output layers are always kept in float32 for numerical stability.
         """
         # Note: keras imports are within functions to prevent initializing keras in processes that import from this file
         from keras.models import Model
         from keras.layers import Input, Conv2D, BatchNormalization, Flatten, Dense, Activation, Add, Reshape
+        from keras.mixed_precision import global_policy, set_global_policy
 
         input_shape = self.GameClass.STATE_SHAPE
         output_shape = self.GameClass.MOVE_SHAPE
-        output_neurons = np.product(output_shape)
-
-        input_tensor = Input(input_shape)
-
-        # convolutional layer
-        x = Conv2D(convolutional_filters, kernel_size, padding='same')(input_tensor)
-        x = BatchNormalization()(x)
-        x = Activation('relu')(x)
-
-        # residual layers
-        for _ in range(residual_layers):
-            y = Conv2D(convolutional_filters, kernel_size, padding='same')(x)
-            y = BatchNormalization()(y)
-            y = Activation('relu')(y)
-            y = Conv2D(convolutional_filters, kernel_size, padding='same')(y)
-            y = BatchNormalization()(y)
-            # noinspection PyTypeChecker
-            x = Add()([x, y])
+        output_neurons = prod(output_shape)
+
+        # layers use the global policy at the time they are created, so it only needs to be set while building the model
+        previous_policy = global_policy()
+        if mixed_precision:
+            set_global_policy('mixed_float16')
+
+        try:
+            input_tensor = Input(input_shape)
+
+            # convolutional layer
+            x = Conv2D(convolutional_filters, kernel_size, padding='same')(input_tensor)
+            x = BatchNormalization()(x)
             x = Activation('relu')(x)
 
-        # policy head
-        policy = Conv2D(2, (1, 1), padding='same')(x)
-        policy = BatchNormalization()(policy)
-        policy = Activation('relu')(policy)
-        policy = Flatten()(policy)
-        policy = Dense(output_neurons, activation='softmax')(policy)
-        policy = Reshape(output_shape, name='policy')(policy)
-
-        # value head
-        value = Conv2D(1, (1, 1), padding='same')(x)
-        value = BatchNormalization()(value)
-        value = Activation('relu')(value)
-        value = Flatten()(value)
-        value = Dense(value_head_neurons, activation='relu')(value)
-        value = Dense(1, activation='tanh', name='value')(value)
-
-        model = Model(input_tensor, [policy, value])
-        model.compile(optimizer='adam', loss={'policy': 'categorical_crossentropy', 'value': 'mean_squared_error'},
+            # residual layers
+            for _ in range(residual_layers):
+                y = Conv2D(convolutional_filters, kernel_size, padding='same')(x)
+                y = BatchNormalization()(y)
+                y = Activation('relu')(y)
+                y = Conv2D(convolutional_filters, kernel_size, padding='same')(y)
+                y = BatchNormalization()(y)
+                # noinspection PyTypeChecker
+                x = Add()([x, y])
+                x = Activation('relu')(x)
+
+            # policy head
+            policy = Conv2D(2, (1, 1), padding='same')(x)
+            policy = BatchNormalization()(policy)
+            policy = Activation('relu')(policy)
+            policy = Flatten()(policy)
+            policy = Dense(output_neurons, activation='softmax', dtype='float32')(policy)
+            policy = Reshape(output_shape, name='policy', dtype='float32')(policy)
+
+            # value head
+            value = Conv2D(1, (1, 1), padding='same')(x)
+            value = BatchNormalization()(value)
+            value = Activation('relu')(value)
+            value = Flatten()(value)
+            value = Dense(value_head_neurons, activation='relu')(value)
+            value = Dense(1, activation='tanh', name='value', dtype='float32')(value)
+
+            model = Model(input_tensor, [policy, value])
+        finally:
+            set_global_policy(previous_policy)
+
+        if train:
+            self.compile_model(model, policy_loss_value)
+        return model
+
+    @staticmethod
+    def compile_model(model, policy_loss_value=1):
+        # Note: keras imports are within functions to prevent initializing keras in processes that import from this file
+        from keras.optimizers import Adam
+        from keras.mixed_precision import LossScaleOptimizer
+
+        optimizer = Adam()
+        if any(layer.dtype_policy.name == 'mixed_float16' for layer in model.layers):
+            # scale the loss to prevent small float16 gradients from underflowing to 0
+            optimizer = LossScaleOptimizer(optimizer)
+        model.compile(optimizer=optimizer,
+                      loss={'policy': 'categorical_crossentropy', 'value': 'mean_squared_error'},
                       loss_weights={'policy': policy_loss_value, 'value': 1},
                       metrics=['mean_squared_error'])
-        return model
+
+    def fold_bn(self):
+        """
+        Replaces the model with an equivalent inference-only model where each BatchNormalization layer that directly
+        follows a Conv2D layer is folded into that Conv2D's kernel and bias. This removes a layer (and a kernel
+        launch) from every convolution, so it should be called before saving or exporting a model for deployment.
+        The folded model can no longer be trained, since the batch statistics are baked into the weights.
+        The network must be initialized.
+        """
+        # Note: keras imports are within functions to prevent initializing keras in processes that import from this file
+        from keras.models import Model
+        from keras.layers import InputLayer, Conv2D, BatchNormalization
+
+        def as_list(tensors):
+            return tensors if isinstance(tensors, list) else [tensors]
+
+        layers = [layer for layer in self.model.layers if not isinstance(layer, InputLayer)]
+        # map each tensor in the model to the layer that produced it, and count how many layers consume it
+        producers = {id(layer.output): layer for layer in layers}
+        consumer_counts = {}
+        for layer in layers:
+            for tensor in as_list(layer.input):
+                consumer_counts[id(tensor)] = consumer_counts.get(id(tensor), 0) + 1
+
+        # find all the batch normalization layers that can be folded into the convolution that feeds them
+        folded_convolutions = {}
+        for layer in layers:
+            if isinstance(layer, BatchNormalization) and layer.axis in [-1, [-1], [3], 3]:
+                convolution = producers.get(id(layer.input))
+                if isinstance(convolution, Conv2D) and consumer_counts[id(convolution.output)] == 1:
+                    folded_convolutions[convolution.name] = layer
+        folded_batch_normalizations = {layer.name for layer in folded_convolutions.values()}
+
+        # rebuild the model layer by layer, skipping the folded batch normalization layers
+        inputs = as_list(self.model.input)
+        new_tensors = {id(tensor): tensor for tensor in inputs}
+        new_layers = []
+        for layer in layers:
+            if layer.name in folded_batch_normalizations:
+                new_tensors[id(layer.output)] = new_tensors[id(layer.input)]
+                continue
+
+            config = layer.get_config()
+            if layer.name in folded_convolutions:
+                config['use_bias'] = True
+            new_layer = layer.__class__.from_config(config)
+            layer_inputs = [new_tensors[id(tensor)] for tensor in as_list(layer.input)]
+            new_tensors[id(layer.output)] = new_layer(layer_inputs if isinstance(layer.input, list)
+                                                      else layer_inputs[0])
+            new_layers.append((layer, new_layer))
+
+        outputs = [new_tensors[id(tensor)] for tensor in as_list(self.model.output)]
+        folded_model = Model(inputs, outputs)
+
+        for layer, new_layer in new_layers:
+            if layer.name not in folded_convolutions:
+                new_layer.set_weights(layer.get_weights())
+                continue
+
+            batch_normalization = folded_convolutions[layer.name]
+            kernel = layer.kernel.numpy()
+            bias = layer.bias.numpy() if layer.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+            gamma = batch_normalization.gamma.numpy() if batch_normalization.scale else 1
+            beta = batch_normalization.beta.numpy() if batch_normalization.center else 0
+            mean = batch_normalization.moving_mean.numpy()
+            variance = batch_normalization.moving_variance.numpy()
+
+            # BN(conv(x)) = gamma * (conv(x) + bias - mean) / sqrt(variance + epsilon) + beta
+            scale = gamma / np.sqrt(variance + batch_normalization.epsilon)
+            new_layer.set_weights([kernel * scale, (bias - mean) * scale + beta])
+
+        self.model = folded_model
+        self.inference_function = self.create_inference_function()
+        self.input_buffers = {}
+
+    def create_inference_function(self):
+        """
+        Compiles the model's forward pass with XLA. This allows the Conv2D, BatchNormalization, Activation and Add
+        layers in each residual block to be fused into a small number of kernels, and skips the per-call overhead of
+        model.predict which dominates for the small batches used during tree search.
+
+        :return: A function that takes a float32 tensor of states and returns the policy and value tensors.
+        """
+        # Note: tensorflow imports are within functions to prevent initializing it in processes that import this file
+        import tensorflow as tf
+
+        model = self.model
+
+        @tf.function(jit_compile=True, reduce_retracing=True,
+                     input_signature=[tf.TensorSpec((None,) + self.GameClass.STATE_SHAPE, tf.float32)])
+        def inference_function(states):
+            return model(states, training=False)
+
+        return inference_function
+
+    def quantize(self, representative_states, precision='int8'):
+        """
+        Replaces the model used by predict with a LiteRT interpreter running a post-training quantized copy of the
+        model. The network must be initialized. The optional ai-edge-litert package provides the interpreter, and
+        tf.lite.Interpreter is used instead if it isn't installed. The quantized copy outputs the policy logits, and the
+        softmax is applied in float32 by predict_quantized so that the probability distribution over moves is not
+        coarsened.
+
+        :param representative_states: Positions with shape (k,) + GameClass.STATE_SHAPE, used to calibrate activation
+                                      ranges when precision is 'int8' (for example the inputs from get_training_data).
+        :param precision: 'fp32' to go back to the original model, 'fp16' to store weights as float16,
+                          or 'int8' to quantize both weights and activations to int8.
+        """
+        # Note: tensorflow imports are within functions to prevent initializing it in processes that import this file
+        import tensorflow as tf
+        from keras.models import Model
+        from keras.layers import Dense
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            # ai-edge-litert is an optional dependency, and tf.lite.Interpreter has the same api
+            Interpreter = tf.lite.Interpreter
+
+        if precision == 'fp32':
+            self.quantized_model = None
+            return
+        if precision not in ['fp16', 'int8']:
+            raise ValueError(f'Unknown precision: {precision}')
+
+        # copy the policy head's final layer without its softmax activation
+        policy_layer = next(layer for layer in self.model.layers
+                            if isinstance(layer, Dense) and layer.get_config()['activation'] == 'softmax')
+        logits_layer = Dense(policy_layer.units, dtype='float32')
+        logits = logits_layer(policy_layer.input)
+        logits_layer.set_weights(policy_layer.get_weights())
+        logits_model = Model(self.model.input, [logits, self.model.get_layer('value').output])
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(logits_model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if precision == 'fp16':
+            converter.target_spec.supported_types = [tf.float16]
+        else:
+            def representative_dataset():
+                for state in representative_states:
+                    yield [state[np.newaxis, ...].astype(np.float32)]
+
+            converter.representative_dataset = representative_dataset
+        self.quantized_model = Interpreter(model_content=converter.convert()).get_signature_runner()
+
+    def predict_quantized(self, states):
+        input_name, = self.quantized_model.get_input_details().keys()
+        outputs = self.quantized_model(**{input_name: states.astype(np.float32, copy=False)})
+        # outputs are named output_0, output_1 in the same order as the outputs of the model passed to the converter
+        logits, evaluations = [outputs[key] for key in sorted(outputs.keys())]
+        exponentials = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+        raw_policies = exponentials / np.sum(exponentials, axis=1, keepdims=True)
+        return raw_policies.reshape((-1,) + self.GameClass.MOVE_SHAPE), evaluations
 
     def predict(self, states):
+        if self.quantized_model is not None:
+            return self.predict_quantized(states)
+
+        if self.inference_function is not None:
+            # pad the batch to the next power of 2, so that only a handful of input shapes are ever compiled and the
+            # compiled programs are replayed instead of being recompiled for every new batch size
+            batch_size = states.shape[0]
+            padded_batch_size = 1 << (batch_size - 1).bit_length()
+            # the input buffer is only stored once the function has been compiled for its batch size
+            input_buffer = self.input_buffers.get(padded_batch_size)
+            compiling = input_buffer is None
+            if compiling:
+                input_buffer = np.zeros((padded_batch_size,) + self.GameClass.STATE_SHAPE, dtype=np.float32)
+            # rows past batch_size hold stale positions from previous calls, but their outputs are discarded
+            input_buffer[:batch_size] = states
+            try:
+                raw_policies, evaluations = self.inference_function(input_buffer)
+                self.input_buffers[padded_batch_size] = input_buffer
+                return raw_policies.numpy()[:batch_size], evaluations.numpy()[:batch_size]
+            except Exception as e:
+                # Note: tensorflow imports are within functions to prevent initializing it in processes that import
+                # this file
+                import tensorflow as tf
+
+                # XLA is not available on every platform, which is reported when the function is first compiled
+                # any other error is a real failure, so it isn't hidden by falling back to the uncompiled model
+                if not compiling or not isinstance(e, (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError)):
+                    raise
+                warnings.warn(f'Compiled inference is unavailable, falling back to the uncompiled model: {e}')
+                self.inference_function = None
+
+        if states.shape[0] <= 256:
+            # calling the model directly skips the dataset adapter used by model.predict, which dominates small batches
+            raw_policies, evaluations = self.model(states, training=False)
+            return np.asarray(raw_policies), np.asarray(evaluations)
         return self.model.predict(states)
 
     def call(self, states):
@@ -122,10 +346,14 @@ class Network:
         """
         raw_policies, evaluations = self.predict(states)
 
-        filtered_policies = [raw_policy[self.GameClass.get_legal_moves(state)]
-                             for state, raw_policy in zip(states, raw_policies)]
-        filtered_policies = [filtered_policy / np.sum(filtered_policy) if len(filtered_policy) > 0 else [1]
-                             for filtered_policy in filtered_policies]
+        # mask and normalize all the policies at once, and only split them up into ragged arrays at the end
+        legal_moves = self.GameClass.get_legal_moves_batch(states)
+        masked_policies = raw_policies * legal_moves
+        sums = masked_policies.reshape(states.shape[0], -1).sum(axis=1)
+        sums = np.where(sums > 0, sums, 1).reshape((-1,) + (1,) * len(self.GameClass.MOVE_SHAPE))
+        normalized_policies = masked_policies / sums
+        filtered_policies = [normalized_policy[legal] if np.any(legal) else [1]
+                             for normalized_policy, legal in zip(normalized_policies, legal_moves)]
 
         evaluations = evaluations.reshape(states.shape[0])
         return [(filtered_policy, evaluation) for filtered_policy, evaluation in zip(filtered_policies, evaluations)]
@@ -140,6 +368,10 @@ class Network:
         # Note: keras imports are within functions to prevent initializing keras in processes that import from this file
         from keras.callbacks import TensorBoard, EarlyStopping
 
+        if getattr(self.model, 'optimizer', None) is None:
+            # models that were loaded for inference only are not compiled
+            self.compile_model(self.model, self.hyper_params.get('policy_loss_value', 1))
+
         split = int((1 - validation_fraction) * len(data))
         train_input, train_output = self.get_training_data(self.GameClass, data[:split])
         test_input, test_output = self.get_training_data(self.GameClass, data[split:])
@@ -180,36 +412,34 @@ class Network:
         :param shuffle:
         :return:
         """
-        states = []
-        policy_outputs = []
-        value_outputs = []
+        # allocate the outputs at their final size, instead of stacking lists of samples at the end
+        sample_count = sum(len(game) for game, _ in data)
+        states_dtype = next((position.dtype for game, _ in data for position, _ in game), float)
+        input_data = np.empty((sample_count,) + GameClass.STATE_SHAPE, dtype=states_dtype)
+        policy_outputs = np.zeros((sample_count,) + GameClass.MOVE_SHAPE)
+        value_outputs = np.empty(sample_count, dtype=np.array([outcome for _, outcome in data]).dtype)
+
+        # shuffle by writing each sample directly into its shuffled row, so that no extra copies need to be made
+        indices = np.random.permutation(sample_count) if shuffle else np.arange(sample_count)
 
+        sample = 0
         for game, outcome in data:
             for position, distribution in game:
+                i = indices[sample]
+                sample += 1
+
                 legal_moves = GameClass.get_legal_moves(position)
-                policy = np.zeros_like(legal_moves, dtype=float)
+                policy = policy_outputs[i]
                 policy[legal_moves] = distribution
                 policy /= np.sum(policy)  # rescale so total probability is 1
 
                 if one_hot:
                     idx = np.unravel_index(policy.argmax(), policy.shape)
-                    policy = np.zeros_like(policy)
+                    policy[...] = 0
                     policy[idx] = 1
 
-                states.append(position)
-                policy_outputs.append(policy)
-                value_outputs.append(outcome)
-
-        input_data = np.stack(states, axis=0)
-        policy_outputs = np.stack(policy_outputs, axis=0)
-        value_outputs = np.array(value_outputs)
-
-        if shuffle:
-            shuffle_indices = np.arange(input_data.shape[0])
-            np.random.shuffle(shuffle_indices)
-            input_data = input_data[shuffle_indices, ...]
-            policy_outputs = policy_outputs[shuffle_indices, ...]
-            value_outputs = value_outputs[shuffle_indices]
+                input_data[i] = position
+                value_outputs[i] = outcome
 
         return input_data, [policy_outputs, value_outputs]
 
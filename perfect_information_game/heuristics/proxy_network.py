@@ -1,20 +1,84 @@
+from math import prod
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
 from perfect_information_game.heuristics import Network
 
 
+class SharedBatchBuffers:
+    """
+    Shared memory for sending a batch of states from a ProxyNetwork to the training process, and the resulting policies
+    and evaluations back, without pickling them through a pipe.
+    """
+
+    def __init__(self, GameClass, max_batch_size):
+        self.GameClass = GameClass
+        self.max_batch_size = max_batch_size
+        self.states_shape = (max_batch_size,) + GameClass.STATE_SHAPE
+        self.policies_shape = (max_batch_size,) + GameClass.MOVE_SHAPE
+        self.evaluations_shape = (max_batch_size, 1)
+        self.states_dtype = GameClass.STARTING_STATE.dtype
+
+        self.states_bytes = prod(self.states_shape) * self.states_dtype.itemsize
+        self.policies_bytes = prod(self.policies_shape) * np.dtype(np.float32).itemsize
+        evaluations_bytes = prod(self.evaluations_shape) * np.dtype(np.float32).itemsize
+        self.shared_memory = SharedMemory(create=True,
+                                          size=self.states_bytes + self.policies_bytes + evaluations_bytes)
+
+        # lazily initialized in each process by calling attach, because numpy views cannot be pickled
+        self.states = None
+        self.policies = None
+        self.evaluations = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['states'] = state['policies'] = state['evaluations'] = None
+        return state
+
+    def attach(self):
+        buffer = self.shared_memory.buf
+        self.states = np.ndarray(self.states_shape, dtype=self.states_dtype, buffer=buffer)
+        self.policies = np.ndarray(self.policies_shape, dtype=np.float32, buffer=buffer, offset=self.states_bytes)
+        self.evaluations = np.ndarray(self.evaluations_shape, dtype=np.float32, buffer=buffer,
+                                      offset=self.states_bytes + self.policies_bytes)
+
+    def unlink(self):
+        """
+        Frees the shared memory. This must be called exactly once, by the process that created it.
+        """
+        self.shared_memory.close()
+        self.shared_memory.unlink()
+
+
 class ProxyNetwork(Network):
-    def __init__(self, GameClass, model_pipe):
+    def __init__(self, GameClass, model_pipe, shared_batch_buffers=None):
+        """
+        :param shared_batch_buffers: If provided, batches of up to shared_batch_buffers.max_batch_size states are
+                                     transferred through shared memory, and only their size is sent through model_pipe.
+                                     Larger batches are still sent through model_pipe.
+        """
         super().__init__(GameClass)
         self.model_pipe = model_pipe
+        self.shared_batch_buffers = shared_batch_buffers
 
     def initialize(self):
-        pass
+        if self.shared_batch_buffers is not None:
+            self.shared_batch_buffers.attach()
 
     def predict(self, states):
-        self.model_pipe.send(states)
-        return self.model_pipe.recv()
+        batch_size = states.shape[0]
+        if self.shared_batch_buffers is None or batch_size > self.shared_batch_buffers.max_batch_size:
+            self.model_pipe.send(states)
+            return self.model_pipe.recv()
+
+        self.shared_batch_buffers.states[:batch_size] = states
+        self.model_pipe.send(batch_size)
+        self.model_pipe.recv()  # wait for the results to be written
+        # copy the results because the buffers will be overwritten by the next call
+        return np.copy(self.shared_batch_buffers.policies[:batch_size]), \
+            np.copy(self.shared_batch_buffers.evaluations[:batch_size])
 
     def create_model(self, kernel_size=(4, 4), convolutional_filters=64, residual_layers=6,
-                     value_head_neurons=16, policy_loss_value=1):
+                     value_head_neurons=16, policy_loss_value=1, train=True, mixed_precision=False):
         raise NotImplementedError('ProxyNetwork does not support this operation!')
 
     def train(self, data, validation_fraction=0.2):
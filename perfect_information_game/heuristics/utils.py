@@ -7,22 +7,33 @@ from signal import signal, SIGTERM
 import numpy as np
 from perfect_information_game.heuristics import Network
 from perfect_information_game.heuristics import ProxyNetwork
+from perfect_information_game.heuristics.proxy_network import SharedBatchBuffers
 from perfect_information_game.utils import get_training_path
 
 
-def spawn_training_process(GameClass, model_path=None, threads=1):
+def spawn_training_process(GameClass, model_path=None, threads=1, max_shared_batch_size=256):
+    """
+    The caller is responsible for calling unlink on the shared_batch_buffers of each of the returned proxy networks
+    once the training process and all the processes using the proxy networks have finished.
+
+    :param max_shared_batch_size: The largest batch that a proxy network can send through shared memory.
+    """
     # double the number of threads so that half of them can work at a time, and then alternate
     parent_pipes, worker_pipes = zip(*[Pipe() for _ in range(2 * threads)])
+    shared_batch_buffers = [SharedBatchBuffers(GameClass, max_shared_batch_size) for _ in range(2 * threads)]
     worker_training_data_pipe, parent_training_data_pipe = Pipe(duplex=False)
     process = Process(target=training_process_loop,
-                      args=(GameClass, model_path, worker_pipes, worker_training_data_pipe))
-    proxy_networks = [ProxyNetwork(GameClass, parent_a_pipe) for parent_a_pipe in parent_pipes]
+                      args=(GameClass, model_path, worker_pipes, shared_batch_buffers, worker_training_data_pipe))
+    proxy_networks = [ProxyNetwork(GameClass, parent_a_pipe, buffers)
+                      for parent_a_pipe, buffers in zip(parent_pipes, shared_batch_buffers)]
     return process, proxy_networks, parent_training_data_pipe
 
 
-def training_process_loop(GameClass, model_path, worker_pipes, training_data_pipe):
+def training_process_loop(GameClass, model_path, worker_pipes, shared_batch_buffers, training_data_pipe):
     network = Network(GameClass, model_path, reinforcement_training=True)
     network.initialize()
+    for buffers in shared_batch_buffers:
+        buffers.attach()
 
     def on_terminate_process(_):
         network.finish_training()
@@ -30,6 +41,10 @@ def training_process_loop(GameClass, model_path, worker_pipes, training_data_pip
         sys.exit(0)
     signal(SIGTERM, on_terminate_process)
 
+    # persistent float32 buffer that the requests are copied into, instead of allocating a new batch for every call
+    batch_buffer = np.empty((len(worker_pipes) // 2 * shared_batch_buffers[0].max_batch_size,) + GameClass.STATE_SHAPE,
+                            dtype=np.float32)
+
     last_save = 0  # initialize to 0 to ensure that the network is saved at the start
     while True:
         if training_data_pipe.poll():
@@ -41,23 +56,41 @@ def training_process_loop(GameClass, model_path, worker_pipes, training_data_pip
                 last_save = time()
 
         # collect requests from whichever workers finish first
+        # each request is either the size of a batch in shared memory, or a batch that was too large for shared memory
         request_indices = []
         requests = []
+        shared_requests = []
         while len(request_indices) < len(worker_pipes) // 2:
             for i, worker_pipe in enumerate(worker_pipes):
                 if i not in request_indices and worker_pipe.poll():
                     request_indices.append(i)
-                    requests.append(worker_pipe.recv())
+                    request = worker_pipe.recv()
+                    shared_requests.append(isinstance(request, int))
+                    requests.append(shared_batch_buffers[i].states[:request] if shared_requests[-1] else request)
 
-        # concatenate is used instead of stack because each request already has shape (k,) + GameClass.STATE_SHAPE
-        raw_policies, evaluations = network.predict(np.concatenate(requests, axis=0))
+        # each request already has shape (k,) + GameClass.STATE_SHAPE, so they can be copied directly into the buffer
+        total_batch_size = sum(request.shape[0] for request in requests)
+        if total_batch_size > batch_buffer.shape[0]:
+            # only happens if some requests were too large for shared memory
+            batch_buffer = np.empty((total_batch_size,) + GameClass.STATE_SHAPE, dtype=np.float32)
+        pos = 0
+        for request in requests:
+            new_pos = pos + request.shape[0]
+            batch_buffer[pos:new_pos] = request
+            pos = new_pos
+        raw_policies, evaluations = network.predict(batch_buffer[:total_batch_size])
 
         # send the results back to the workers as fast as possible
         pos = 0
-        for i, request in zip(request_indices, requests):
+        for i, request, shared_request in zip(request_indices, requests, shared_requests):
             new_pos = pos + request.shape[0]
-            # This send call will not block because the receiver will always be waiting to read the result
-            worker_pipes[i].send((raw_policies[pos:new_pos], evaluations[pos:new_pos]))
+            # These send calls will not block because the receiver will always be waiting to read the result
+            if shared_request:
+                shared_batch_buffers[i].policies[:request.shape[0]] = raw_policies[pos:new_pos]
+                shared_batch_buffers[i].evaluations[:request.shape[0]] = evaluations[pos:new_pos]
+                worker_pipes[i].send(None)
+            else:
+                worker_pipes[i].send((raw_policies[pos:new_pos], evaluations[pos:new_pos]))
             pos = new_pos
 
 
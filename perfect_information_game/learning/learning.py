@@ -12,13 +12,16 @@ from perfect_information_game.utils import get_training_path
 
 class SelfPlayReinforcementLearning:
     def __init__(self, GameClass, model_path, threads=14, game_batch_size=6, expansions_per_move=500,
-                 c=np.sqrt(2), d=1, replay_buffer_size=1000):
+                 c=np.sqrt(2), d=1, replay_buffer_size=1000, leaves_per_game=1):
         """
         If network is None, then self play will be done using random MCTS rollouts and saved to
         {get_training_path(GameClass)}/games/reinforcement_learning_games/
+
+        :param leaves_per_game: The maximum number of leaves to expand in each game per network call. Using virtual
+                                loss to choose several leaves per game makes each network call larger.
         """
         path = f'{get_training_path(GameClass)}/games/reinforcement_learning_games'
-        self.network_process, network_proxies, network_training_data_pipe = \
+        self.network_process, self.network_proxies, network_training_data_pipe = \
             spawn_training_process(GameClass, model_path, threads)
 
         # We must use a queue instead of a pipe because the replay buffer process will not
@@ -29,8 +32,8 @@ class SelfPlayReinforcementLearning:
         worker_training_data_queue = Queue()
         self.worker_processes = [Process(target=SelfPlayReinforcementLearning.game_batch_simulation_worker,
                                          args=(GameClass, worker_training_data_queue, network_proxy, path,
-                                               expansions_per_move, game_batch_size, c, d))
-                                 for network_proxy in network_proxies]
+                                               expansions_per_move, game_batch_size, c, d, leaves_per_game))
+                                 for network_proxy in self.network_proxies]
 
         self.replay_buffer_process = Process(target=SelfPlayReinforcementLearning.replay_buffer_process_loop,
                                              args=(GameClass, worker_training_data_queue, network_training_data_pipe,
@@ -60,9 +63,12 @@ class SelfPlayReinforcementLearning:
         for worker_process in self.worker_processes:
             worker_process.join()
 
+        for network_proxy in self.network_proxies:
+            network_proxy.shared_batch_buffers.unlink()
+
     @staticmethod
     def game_batch_simulation_worker(GameClass, response_queue, network, path,
-                                     expansions_per_move, game_batch_size, c, d):
+                                     expansions_per_move, game_batch_size, c, d, leaves_per_game=1):
         """
         Simulates several games in series, and aggregates and batches all their network call requests.
         """
@@ -97,8 +103,8 @@ class SelfPlayReinforcementLearning:
 
                     roots[i] = root
 
-                best_node = root.choose_expansion_node()
-                if best_node is None:
+                game_best_nodes = root.choose_expansion_nodes(leaves_per_game)
+                if len(game_best_nodes) == 0:
                     while root.children is not None:
                         best_node, distribution = root.choose_best_node(return_probability_distribution=True)
                         training_data_sets[i].append((root.position, distribution))
@@ -112,21 +118,13 @@ class SelfPlayReinforcementLearning:
                     root = HeuristicNode(GameClass.STARTING_STATE, parent=None, GameClass=GameClass, network=None,
                                          c=c, d=d, network_call_results=(np.copy(starting_policy), starting_evaluation))
                     roots[i] = root
-                    best_node = root.choose_expansion_node()
-                best_nodes.append(best_node)
-
-            # batch evaluations for all possible moves for the best_node in all game_batch_size games
-            best_nodes_moves = [GameClass.get_possible_moves(best_node.position) for best_node in best_nodes]
-            network_call_results_batch = network.call(np.stack([position for moves in best_nodes_moves
-                                                                for position in moves], axis=0))
-
-            # un-batch network call results, and tell each best_node to expand with its respective network call results
-            pos = 0
-            for best_node, moves in zip(best_nodes, best_nodes_moves):
-                new_pos = pos + len(moves)
-                network_call_results = network_call_results_batch[pos:new_pos]
-                best_node.expand(moves, network_call_results)
-                pos = new_pos
+                    game_best_nodes = root.choose_expansion_nodes(leaves_per_game)
+                best_nodes.extend(game_best_nodes)
+
+            # batch evaluations for all possible moves for the best_nodes in all game_batch_size games
+            for best_node in best_nodes:
+                best_node.revert_virtual_loss()
+            HeuristicNode.expand_nodes(best_nodes, network)
 
     @staticmethod
     def replay_buffer_process_loop(GameClass, training_game_queue, network_training_pipe, path, replay_buffer_size,
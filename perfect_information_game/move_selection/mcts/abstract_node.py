@@ -3,16 +3,185 @@ import numpy as np
 
 
 class AbstractNode(ABC):
-    def __init__(self, position, parent, GameClass, c=np.sqrt(2), verbose=False):
+    # structured dtype of the statistics stored for each node, must include a boolean 'fully_expanded' field
+    STATISTICS_DTYPE = None
+
+    def __init__(self, position, parent, GameClass, c=np.sqrt(2), verbose=False, statistics=None,
+                 transposition_table=None, is_over=None):
+        """
+        The statistics of sibling nodes are stored contiguously in their parent's children_statistics array,
+        so that choose_expansion_node can compute the heuristics for all children at once.
+
+        :param statistics: The element of the parent's children_statistics array that corresponds to this node.
+                           If None, then a standalone element will be created.
+        :param transposition_table: A dictionary shared by all the nodes in the search tree, which maps
+                                    get_transposition_key to nodes. If provided, positions that can be reached by
+                                    multiple move orders will share a single node, turning the tree into a DAG.
+                                    In that case, parent is the parent through which the node was last selected.
+        :param is_over: GameClass.is_over(position), if it is already known.
+        """
         self.position = position
         self.parent = parent
+        self.depth = parent.depth + 1 if parent is not None else 0
         self.GameClass = GameClass
         self.c = c
-        self.fully_expanded = GameClass.is_over(position)
+        self.statistics = statistics if statistics is not None else np.zeros(1, dtype=self.STATISTICS_DTYPE)[0]
+        self.fully_expanded = GameClass.is_over(position) if is_over is None else is_over
         self.is_maximizing = GameClass.is_player_1_turn(position)
+        # 1 if maximizing and -1 if minimizing, so that heuristics can be compared without branching on is_maximizing
+        self.optimal_value = 1 if self.is_maximizing else -1
+        # lazily computed by get_possible_moves, so that leaves that are never expanded don't hold on to their moves
+        self.possible_moves = None
         self.children = None
+        self.children_statistics = None
+        # maps the zobrist hash of each child's position to the child's index, lazily computed by find_child
+        self.children_by_hash = None
+        # indices of the children that were found in the transposition table, and so are also the children of other nodes
+        self.transposed_children_indices = []
+        # the moves and create_child function of children that are only created once get_child is called for them
+        self.deferred_moves = None
+        self.create_deferred_child = None
         self.verbose = verbose
 
+        self.transposition_table = transposition_table
+        # computed once, so that reset_transposition_table doesn't need to hash every node in the tree again
+        self.transposition_key = None
+        if transposition_table is not None:
+            self.transposition_key = self.get_transposition_key(position, self.depth)
+            transposition_table[self.transposition_key] = self
+
+    @property
+    def fully_expanded(self):
+        return self.statistics['fully_expanded']
+
+    @fully_expanded.setter
+    def fully_expanded(self, fully_expanded):
+        self.statistics['fully_expanded'] = fully_expanded
+
+    def create_children_statistics(self, count):
+        """
+        Allocates the children_statistics array for count children.
+
+        :return: A list of the elements of children_statistics, one to be passed to the constructor of each child.
+        """
+        self.children_statistics = np.zeros(count, dtype=self.STATISTICS_DTYPE)
+        return [self.children_statistics[i] for i in range(count)]
+
+    def get_possible_moves(self):
+        if self.possible_moves is None:
+            self.possible_moves = self.GameClass.get_possible_moves(self.position)
+        return self.possible_moves
+
+    def get_transposition_key(self, position, depth):
+        # only nodes at the same depth are merged, which guarantees that the search tree can't contain cycles
+        return depth, self.GameClass.zobrist_hash(position)
+
+    def find_transpositions(self, moves):
+        """
+        :return: A list with the existing node for each of the given child positions that is in the transposition table,
+                 or None for the positions that are not.
+        """
+        if self.transposition_table is None:
+            return [None] * len(moves)
+        return [self.transposition_table.get(self.get_transposition_key(move, self.depth + 1)) for move in moves]
+
+    def create_children(self, moves, create_child, transpositions=None, lazy=False):
+        """
+        Sets self.children and self.children_statistics. Children that are already in the transposition table are reused
+        instead of being created again.
+
+        :param create_child: A function that takes the index of a move, the move, and the child's statistics element,
+                             and returns a new child node.
+        :param transpositions: The result of find_transpositions(moves), if it has already been computed.
+        :param lazy: If True, then new children are left as None in self.children until get_child is called for them.
+                     In that case, the caller is responsible for initializing their entries in children_statistics.
+        """
+        transpositions = self.find_transpositions(moves) if transpositions is None else transpositions
+        children_statistics = self.create_children_statistics(len(moves))
+        self.children = []
+        for i, (move, transposition, statistics) in enumerate(zip(moves, transpositions, children_statistics)):
+            if transposition is not None:
+                self.transposed_children_indices.append(i)
+                self.children.append(transposition)
+            else:
+                self.children.append(None if lazy else create_child(i, move, statistics))
+        if lazy:
+            self.deferred_moves = moves
+            self.create_deferred_child = create_child
+        self.update_transposed_children_statistics()
+
+    def get_child(self, index):
+        """
+        :return: The child at the given index, creating it first if its creation was deferred by create_children.
+        """
+        child = self.children[index]
+        if child is None:
+            move = self.deferred_moves[index]
+            # the position may have been reached through another parent since this node's children were created
+            child = self.find_transpositions([move])[0]
+            if child is not None:
+                self.transposed_children_indices.append(index)
+                self.children_statistics[index] = child.statistics
+            else:
+                child = self.create_deferred_child(index, move, self.children_statistics[index])
+            self.children[index] = child
+        return child
+
+    def find_child(self, position):
+        """
+        :return: The child with the given position, or None if there is no such child.
+        """
+        if self.children_by_hash is None:
+            self.children_by_hash = {self.get_child_hash(i): i for i in range(len(self.children))}
+        index = self.children_by_hash.get(self.GameClass.zobrist_hash(position))
+        # check the position in case of a hash collision
+        if index is None or not np.array_equal(self.get_child_position(index), position):
+            return None
+        return self.get_child(index)
+
+    def get_child_position(self, index):
+        """
+        :return: The position of the child at the given index, without creating it if its creation was deferred.
+        """
+        child = self.children[index]
+        return self.deferred_moves[index] if child is None else child.position
+
+    def get_child_hash(self, index):
+        """
+        :return: The zobrist hash of the position of the child at the given index, without creating it if its creation
+                 was deferred.
+        """
+        child = self.children[index]
+        # reuse the hashes that were already computed for the transposition table if possible
+        if child is not None and child.transposition_key is not None:
+            return child.transposition_key[1]
+        return self.GameClass.zobrist_hash(self.get_child_position(index))
+
+    def update_transposed_children_statistics(self):
+        """
+        The statistics of a transposed child are stored in the children_statistics array of the parent that created it,
+        so the copies in this node's children_statistics array need to be refreshed before they are used.
+        """
+        for i in self.transposed_children_indices:
+            self.children_statistics[i] = self.children[i].statistics
+
+    def reset_transposition_table(self):
+        """
+        Removes all the nodes that are no longer reachable from this node from the transposition table.
+        This should be called after making this node the new root of the search tree.
+        """
+        if self.transposition_table is None:
+            return
+        self.transposition_table.clear()
+        stack = [self]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.transposition_key in self.transposition_table:
+                continue
+            self.transposition_table[node.transposition_key] = node
+            if node.children is not None:
+                stack.extend(child for child in node.children if child is not None)
+
     @abstractmethod
     def get_evaluation(self):
         pass
@@ -26,7 +195,28 @@ class AbstractNode(ABC):
         pass
 
     @abstractmethod
-    def get_puct_heuristic_for_child(self, i):
+    def get_children_evaluations(self):
+        """
+        :return: A numpy array with the evaluation of each child.
+        """
+        pass
+
+    @abstractmethod
+    def get_children_expansions(self):
+        """
+        :return: A numpy array with the count_expansions of each child.
+        """
+        pass
+
+    @abstractmethod
+    def select_child(self):
+        """
+        Chooses which child the search should continue with, or determines that this node is fully expanded.
+        This is called at every level of every search, so it should be vectorized or compiled.
+
+        :return: A tuple of the index of the chosen child and None, or None and the minimax evaluation of this node if
+                 all of its children are fully expanded or one of them is already optimal.
+        """
         pass
 
     @abstractmethod
@@ -38,114 +228,123 @@ class AbstractNode(ABC):
         pass
 
     def choose_best_node(self, return_probability_distribution=False, optimal=False):
-        distribution = []
+        self.update_transposed_children_statistics()
+        fully_expanded = self.children_statistics['fully_expanded']
+        evaluations = self.get_children_evaluations()
 
-        optimal_value = 1 if self.is_maximizing else -1
         if self.fully_expanded:
             if self.verbose:
-                if self.get_evaluation() == optimal_value:
+                if self.get_evaluation() == self.optimal_value:
                     print('I\'m going to win')
                 elif self.get_evaluation() == 0:
                     print('It\'s a draw')
                 else:
                     print('I resign')
 
-            for child in self.children:
-                # only consider children that result in the optimal outcome
-                if child.fully_expanded and child.get_evaluation() == self.get_evaluation():
-                    # TODO: when losing, consider the number of ways the opponent can win in response to a move
-                    depth_to_endgame = child.depth_to_end_game()
-                    # if we are winning, weight smaller depths much more strongly by using e^-x
-                    # if we are losing or drawing, weight larger depths much more strongly by using e^x
-                    relative_probability = np.exp(-depth_to_endgame if self.get_evaluation() == optimal_value else
-                                                  depth_to_endgame)
-                    distribution.append(relative_probability)
-                else:
-                    distribution.append(0)
+            # only consider children that result in the optimal outcome
+            optimal_children_indices = np.flatnonzero(fully_expanded & (evaluations == self.get_evaluation()))
+            # TODO: when losing, consider the number of ways the opponent can win in response to a move
+            depths_to_end_game = np.array([self.get_child(i).depth_to_end_game() for i in optimal_children_indices])
+            # if we are winning, weight smaller depths much more strongly by using e^-x
+            # if we are losing or drawing, weight larger depths much more strongly by using e^x
+            distribution = np.zeros(len(self.children))
+            distribution[optimal_children_indices] = np.exp(-depths_to_end_game
+                                                            if self.get_evaluation() == self.optimal_value else
+                                                            depths_to_end_game)
         else:
-            for child in self.children:
-                if not child.fully_expanded:
-                    distribution.append(child.count_expansions())
-                elif child.get_evaluation() == -optimal_value:
-                    # this move is guaranteed to lose
-                    distribution.append(0)
-                else:
-                    # use the self.heuristic as a proxy for the chance of winning the game
-                    # the greater the perceived chance of winning the less appealing a draw is, and vice versa
-                    winning_chance = (self.get_evaluation() * optimal_value) / 2 + 0.5
-                    distribution.append(self.count_expansions() * (1 - winning_chance))
+            # use the self.heuristic as a proxy for the chance of winning the game
+            # the greater the perceived chance of winning the less appealing a draw is, and vice versa
+            winning_chance = (self.get_evaluation() * self.optimal_value) / 2 + 0.5
+            distribution = np.where(~fully_expanded, self.get_children_expansions(),
+                                    # moves that are guaranteed to lose are never chosen
+                                    np.where(evaluations == -self.optimal_value, 0,
+                                             self.count_expansions() * (1 - winning_chance))).astype(np.float64)
 
-        distribution = np.array(distribution) / sum(distribution) if sum(distribution) > 0 else \
-            np.full_like(distribution, 1 / len(distribution), dtype=float)
+        distribution_sum = np.sum(distribution)
+        distribution = distribution / distribution_sum if distribution_sum > 0 else \
+            np.full(len(distribution), 1 / len(distribution))
         idx = np.argmax(distribution) if optimal else np.random.choice(np.arange(len(distribution)), p=distribution)
-        best_child = self.children[idx]
+        best_child = self.get_child(idx)
         return (best_child, distribution) if return_probability_distribution else best_child
 
     def choose_expansion_node(self):
         # TODO: continue tree search in case the user makes a mistake and the game continues
-        if self.fully_expanded:
-            return None
+        # descend iteratively rather than recursively to avoid a python stack frame per ply
+        node = self
+        while node is not None:
+            if node.fully_expanded:
+                return None
 
-        if self.count_expansions() == 0:
-            return self
-
-        self.ensure_children()
-        best_heuristic = -np.inf if self.is_maximizing else np.inf
-        best_child = None
-        for i, child in enumerate(self.children):
-            # don't bother exploring fully expanded children
-            if child.fully_expanded:
-                optimal_value = 1 if self.is_maximizing else -1
-                # If this child is already optimal, then self is fully expanded and there is no point searching further
-                if child.get_evaluation() == optimal_value:
-                    self.set_fully_expanded(optimal_value)
-                    return self.parent.choose_expansion_node() if self.parent is not None else None
-                # continue searching other children, there may be another child that is more optimal
-                continue
+            if node.count_expansions() == 0:
+                return node
 
-            # check puct heuristic before calling child.get_evaluation() because it may result in division by 0
-            puct_heuristic = self.get_puct_heuristic_for_child(i)
-            if np.isinf(puct_heuristic):
-                return child
+            node.ensure_children()
+            node.update_transposed_children_statistics()
+            index, minimax_evaluation = node.select_child()
+            if index is None:
+                if node.verbose and node.parent is None:
+                    print('Fully expanded tree!')
 
-            if self.is_maximizing:
-                combined_heuristic = child.get_evaluation() + puct_heuristic
-                if combined_heuristic > best_heuristic:
-                    best_heuristic = combined_heuristic
-                    best_child = child
-            else:
-                combined_heuristic = child.get_evaluation() - puct_heuristic
-                if combined_heuristic < best_heuristic:
-                    best_heuristic = combined_heuristic
-                    best_child = child
+                node.set_fully_expanded(minimax_evaluation)
+                # this node is now fully expanded, so ask the parent to try to choose again
+                # if no parent is available (i.e. this is the root node) then the entire search tree has been expanded
+                node = node.parent
+                continue
 
-        # if nothing was found because all children are fully expanded
-        if best_child is None:
-            if self.verbose and not self.fully_expanded and self.parent is None:
-                print('Fully expanded tree!')
+            best_child = node.get_child(index)
+            if best_child.fully_expanded:
+                # a deferred child was found in the transposition table after being fully expanded through another
+                # parent, and get_child has updated its statistics, so choose again
+                continue
+            # transposed children can have multiple parents, so keep track of the one that the search went through
+            best_child.parent = node
+            node = best_child
+        return None
 
-            minimax_evaluation = max([child.get_evaluation() for child in self.children]) if self.is_maximizing \
-                else min([child.get_evaluation() for child in self.children])
-            self.set_fully_expanded(minimax_evaluation)
-            # this node is now fully expanded, so ask the parent to try to choose again
-            # if no parent is available (i.e. this is the root node) then the entire search tree has been expanded
-            return self.parent.choose_expansion_node() if self.parent is not None else None
+    def expand_best_nodes(self, count=1):
+        """
+        Chooses and expands up to count nodes in the subtree of this node.
 
-        return best_child.choose_expansion_node()
+        :return: False if the tree has been fully expanded, True otherwise.
+        """
+        best_node = self.choose_expansion_node()
+        if best_node is None:
+            return False
+        best_node.expand()
+        return True
 
     def depth_to_end_game(self):
         if not self.fully_expanded:
             raise Exception('Node not fully expanded!')
 
-        if self.children is None:
-            return 0
+        # traverse the tree iteratively in post order to avoid a python stack frame per ply
+        # the depths are keyed by node rather than path, because transposed nodes can be reached through multiple parents
+        depths = {}
+        stack = [self]
+        while len(stack) > 0:
+            node = stack[-1]
+            if id(node) in depths:
+                stack.pop()
+                continue
+
+            if node.children is None:
+                depths[id(node)] = 0
+                stack.pop()
+                continue
 
-        optimal_value = 1 if self.is_maximizing else -1
-        if self.get_evaluation() == optimal_value:
+            node.update_transposed_children_statistics()
+            optimal_children = [node.get_child(i) for i in np.flatnonzero(
+                node.children_statistics['fully_expanded'] &
+                (node.get_children_evaluations() == node.get_evaluation()))]
+            unvisited_children = [child for child in optimal_children if id(child) not in depths]
+            if len(unvisited_children) > 0:
+                stack.extend(unvisited_children)
+                continue
+
+            children_depths = [depths[id(child)] for child in optimal_children]
             # if we are winning, win as fast as possible
-            return 1 + min(child.depth_to_end_game() for child in self.children
-                           if child.fully_expanded and child.get_evaluation() == self.get_evaluation())
-        else:
             # if we are losing or it is a draw, lose as slow as possible
-            return 1 + max(child.depth_to_end_game() for child in self.children
-                           if child.fully_expanded and child.get_evaluation() == self.get_evaluation())
+            depths[id(node)] = 1 + (min(children_depths) if node.get_evaluation() == node.optimal_value else
+                                     max(children_depths))
+            stack.pop()
+        return depths[id(self)]
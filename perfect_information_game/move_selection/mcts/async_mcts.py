@@ -1,5 +1,6 @@
-from multiprocessing import Pipe, Pool
+from multiprocessing import Pipe, Event
 from multiprocessing.context import Process
+from multiprocessing.shared_memory import SharedMemory
 from time import time
 import numpy as np
 from perfect_information_game.move_selection.mcts import HeuristicNode
@@ -10,22 +11,39 @@ from perfect_information_game.move_selection import MoveChooser
 class AsyncMCTS(MoveChooser):
     """
     Implementation of Monte Carlo Tree Search that uses the other player's time to continue thinking.
-    This is achieved using multiprocessing, and a Pipe for transferring data to and from the worker process.
+    This is achieved using multiprocessing. User chosen moves are transferred to the worker process through shared
+    memory, and the worker's chosen moves are sent back through a Pipe.
     """
 
-    def __init__(self, GameClass, starting_position, time_limit=3, network=None, c=np.sqrt(2), d=1, threads=1):
+    def __init__(self, GameClass, starting_position, time_limit=3, network=None, c=np.sqrt(2), d=1, threads=1,
+                 leaf_batch_size=1, use_transposition_table=True):
         """
         Either:
-        If network is provided, threads must be 1.
+        If network is provided, threads must be 1, and up to leaf_batch_size leaves will be evaluated per network call.
         If network is not provided, then threads will be used for leaf parallelization
+
+        If use_transposition_table is True, then positions that are reached through different move orders will share
+        their statistics.
         """
         super().__init__(GameClass, starting_position)
         if network is not None and threads != 1:
             raise Exception('Threads != 1 with Network != None')
 
-        self.parent_pipe, worker_pipe = Pipe()
+        # the worker polls for user moves between every expansion, so they are written directly into shared memory and
+        # signalled with events, which avoids pickling them and checking a pipe each time
+        self.user_position_memory = SharedMemory(create=True, size=starting_position.nbytes)
+        self.user_position = np.ndarray(starting_position.shape, dtype=starting_position.dtype,
+                                        buffer=self.user_position_memory.buf)
+        self.user_move_ready = Event()
+        self.user_move_consumed = Event()
+        self.user_move_consumed.set()
+        self.choose_move_requested = Event()
+
+        self.parent_pipe, worker_pipe = Pipe(duplex=False)
         self.worker_process = Process(target=self.loop_func,
                                       args=(GameClass, starting_position, time_limit, network, c, d, threads,
+                                            leaf_batch_size, use_transposition_table, self.user_position_memory,
+                                            self.user_move_ready, self.user_move_consumed, self.choose_move_requested,
                                             worker_pipe))
 
     def start(self):
@@ -38,7 +56,11 @@ class AsyncMCTS(MoveChooser):
 
         :param user_chosen_move:
         """
-        self.parent_pipe.send(user_chosen_move)
+        # wait for the worker to copy the previously reported move before overwriting it
+        self.user_move_consumed.wait()
+        self.user_move_consumed.clear()
+        self.user_position[...] = user_chosen_move
+        self.user_move_ready.set()
         self.position = user_chosen_move
 
     def choose_move(self, return_distribution=False):
@@ -50,7 +72,9 @@ class AsyncMCTS(MoveChooser):
 
         :return: The moves chosen by monte carlo tree search.
         """
-        self.parent_pipe.send(None)
+        # the worker must narrow its search tree with any reported user moves before choosing a move
+        self.user_move_consumed.wait()
+        self.choose_move_requested.set()
         chosen_positions = self.parent_pipe.recv()
         self.position = chosen_positions[-1][0]
         return chosen_positions if return_distribution else [position for position, _ in chosen_positions]
@@ -58,52 +82,53 @@ class AsyncMCTS(MoveChooser):
     def terminate(self):
         self.worker_process.terminate()
         self.worker_process.join()
+        self.user_position_memory.close()
+        self.user_position_memory.unlink()
 
     @staticmethod
-    def loop_func(GameClass, position, time_limit, network, c, d, threads, worker_pipe):
+    def loop_func(GameClass, position, time_limit, network, c, d, threads, leaf_batch_size, use_transposition_table,
+                  user_position_memory, user_move_ready, user_move_consumed, choose_move_requested, worker_pipe):
+        user_position = np.ndarray(position.shape, dtype=position.dtype, buffer=user_position_memory.buf)
+        transposition_table = {} if use_transposition_table else None
         if network is None:
-            pool = Pool(threads) if threads > 1 else None
+            pool = RolloutNode.create_pool(GameClass, threads)
             root = RolloutNode(position, parent=None, GameClass=GameClass, c=c, rollout_batch_size=threads, pool=pool,
-                               verbose=True)
+                               workers=threads, verbose=True, transposition_table=transposition_table)
         else:
             network.initialize()
-            root = HeuristicNode(position, None, GameClass, network, c, d, verbose=True)
+            root = HeuristicNode(position, None, GameClass, network, c, d, verbose=True,
+                                 transposition_table=transposition_table)
 
         while True:
-            best_node = root.choose_expansion_node()
-
-            if best_node is not None:
-                best_node.expand()
+            root.expand_best_nodes(leaf_batch_size)
 
-            if root.children is not None and worker_pipe.poll():
-                user_chosen_position = worker_pipe.recv()
+            if root.children is not None:
+                if user_move_ready.is_set():
+                    user_chosen_position = np.copy(user_position)
+                    user_move_ready.clear()
+                    user_move_consumed.set()
 
-                if user_chosen_position is not None:
                     # an updated position has been received so we can truncate the tree
-                    for child in root.children:
-                        if np.all(child.position == user_chosen_position):
-                            root = child
-                            root.parent = None
-                            break
-                    else:
+                    child = root.find_child(user_chosen_position)
+                    if child is None:
                         print(user_chosen_position)
                         raise Exception('Invalid user chosen move!')
+                    root = child
+                    root.parent = None
+                    root.reset_transposition_table()
 
                     if GameClass.is_over(root.position):
                         print('Game Over in Async MCTS: ', GameClass.get_winner(root.position))
                         return
-                else:
+                elif choose_move_requested.is_set():
                     # this move chooser has been requested to decide on a move via the choose_move function
+                    choose_move_requested.clear()
                     start_time = time()
                     while time() - start_time < time_limit:
-                        best_node = root.choose_expansion_node()
-
-                        # best_node will be None if the tree is fully expanded
-                        if best_node is None:
+                        # expand_best_nodes will return False if the tree is fully expanded
+                        if not root.expand_best_nodes(leaf_batch_size):
                             break
 
-                        best_node.expand()
-
                     is_ai_player_1 = GameClass.is_player_1_turn(root.position)
                     chosen_positions = []
                     print(f'MCTS choosing move based on {root.count_expansions()} expansions!')
@@ -111,14 +136,13 @@ class AsyncMCTS(MoveChooser):
                     # choose moves as long as it is still the ai's turn
                     while GameClass.is_player_1_turn(root.position) == is_ai_player_1:
                         if root.children is None:
-                            best_node = root.choose_expansion_node()
-                            if best_node is not None:
-                                best_node.expand()
+                            root.expand_best_nodes()
                         root, distribution = root.choose_best_node(return_probability_distribution=True, optimal=True)
                         chosen_positions.append((root.position, distribution))
 
                     print('Expected outcome: ', root.get_evaluation())
                     root.parent = None  # delete references to the parent and siblings
+                    root.reset_transposition_table()
                     worker_pipe.send(chosen_positions)
                     if GameClass.is_over(root.position):
                         print('Game Over in Async MCTS: ', GameClass.get_winner(root.position))
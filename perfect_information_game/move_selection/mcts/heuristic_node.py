@@ -1,13 +1,25 @@
+import math
 import numpy as np
 from perfect_information_game.move_selection.mcts import AbstractNode
 
 
 class HeuristicNode(AbstractNode):
+    # the network's outputs are float32 anyway, and the expansion counts can't be integers because fully expanded nodes
+    # have infinite expansions
+    STATISTICS_DTYPE = np.dtype([('heuristic', np.float32), ('expansions', np.float32), ('fully_expanded', np.bool_)])
+
     def __init__(self, position, parent, GameClass, network, c=np.sqrt(2), d=1, network_call_results=None,
-                 verbose=False):
-        super().__init__(position, parent, GameClass, c, verbose)
+                 verbose=False, statistics=None, transposition_table=None, is_over=None):
+        super().__init__(position, parent, GameClass, c, verbose, statistics, transposition_table, is_over)
         self.network = network
         self.d = d
+        # the true heuristic of this node while a virtual loss is applied to it, or None if there is no virtual loss
+        self.heuristic_before_virtual_loss = None
+        # the parents that were given a virtual expansion, which may differ from the current parents if transpositions
+        # cause the search to reach one of them through a different path before the virtual loss is reverted
+        self.virtual_loss_ancestors = []
+        # d times the policy of this node as a contiguous array, created with children_statistics by ensure_children
+        self.children_policy_terms = None
 
         if self.fully_expanded:
             self.heuristic = GameClass.get_winner(position)
@@ -18,31 +30,45 @@ class HeuristicNode(AbstractNode):
                 else network_call_results
             self.expansions = 0
 
+    @property
+    def heuristic(self):
+        return self.statistics['heuristic']
+
+    @heuristic.setter
+    def heuristic(self, heuristic):
+        self.statistics['heuristic'] = heuristic
+
+    @property
+    def expansions(self):
+        return self.statistics['expansions']
+
+    @expansions.setter
+    def expansions(self, expansions):
+        self.statistics['expansions'] = expansions
+
     def count_expansions(self):
         return self.expansions
 
     def get_evaluation(self):
         return self.heuristic
 
-    def expand(self, moves=None, network_call_results=None):
+    def expand(self, moves=None, network_call_results=None, transpositions=None):
         if self.children is not None:
             raise Exception('Node already has children!')
         if self.fully_expanded:
             raise Exception('Node is terminal!')
 
-        self.ensure_children(moves, network_call_results)
+        self.ensure_children(moves, network_call_results, transpositions)
         if self.children is None:
             raise Exception('Failed to create children!')
 
-        critical_value = max([child.heuristic for child in self.children]) if self.is_maximizing else \
-            min([child.heuristic for child in self.children])
+        critical_value = self.optimal_value * np.max(self.optimal_value * self.get_children_evaluations())
         self.heuristic = critical_value
 
         # update heuristic for all parents if it beats their current best heuristic
         node = self.parent
         while node is not None:
-            if (node.is_maximizing and critical_value > node.heuristic) or \
-                    (not node.is_maximizing and critical_value < node.heuristic):
+            if node.optimal_value * (critical_value - node.heuristic) > 0:
                 node.heuristic = critical_value
                 node.expansions += 1
                 node = node.parent
@@ -58,22 +84,148 @@ class HeuristicNode(AbstractNode):
             node.expansions += 1
             node = node.parent
 
+    def apply_virtual_loss(self):
+        """
+        Temporarily makes this node look like a loss for the player choosing it, and counts a virtual expansion for all
+        its parents. This steers choose_expansion_node towards other nodes until revert_virtual_loss is called.
+        """
+        self.heuristic_before_virtual_loss = self.heuristic
+        if self.parent is not None:
+            self.heuristic = -self.parent.optimal_value
+
+        node = self.parent
+        while node is not None:
+            node.expansions += 1
+            self.virtual_loss_ancestors.append(node)
+            node = node.parent
+
+    def revert_virtual_loss(self):
+        self.heuristic = self.heuristic_before_virtual_loss
+        self.heuristic_before_virtual_loss = None
+
+        for node in self.virtual_loss_ancestors:
+            node.expansions -= 1
+        self.virtual_loss_ancestors = []
+
+    def choose_expansion_nodes(self, count):
+        """
+        Chooses up to count distinct nodes to expand, so that their network calls can be batched together.
+        Each chosen node has a virtual loss applied to it, which must be reverted before it is expanded.
+        """
+        best_nodes = []
+        while len(best_nodes) < count:
+            best_node = self.choose_expansion_node()
+            # stop early if the search keeps returning to a node that has already been chosen
+            if best_node is None or best_node.heuristic_before_virtual_loss is not None:
+                break
+            best_node.apply_virtual_loss()
+            best_nodes.append(best_node)
+        return best_nodes
+
+    def expand_best_nodes(self, count=1):
+        best_nodes = self.choose_expansion_nodes(count)
+        if len(best_nodes) == 0:
+            return False
+
+        for best_node in best_nodes:
+            best_node.revert_virtual_loss()
+        HeuristicNode.expand_nodes(best_nodes, self.network)
+        return True
+
+    @staticmethod
+    def expand_nodes(nodes, network):
+        """
+        Expands all the given nodes, which may belong to different search trees, using a single network call.
+        Any virtual losses applied to the nodes must be reverted first.
+        """
+        # batch evaluations for all possible moves of every node into a single network call
+        # moves that are already in the transposition table don't need to be evaluated again
+        nodes_moves = [node.get_possible_moves() for node in nodes]
+        nodes_transpositions = [node.find_transpositions(moves) for node, moves in zip(nodes, nodes_moves)]
+        new_positions = [position for moves, transpositions in zip(nodes_moves, nodes_transpositions)
+                         for position, transposition in zip(moves, transpositions) if transposition is None]
+        network_call_results_batch = iter(network.call(np.stack(new_positions, axis=0))
+                                          if len(new_positions) > 0 else [])
+
+        # un-batch network call results, and tell each node to expand with its respective network call results
+        for node, moves, transpositions in zip(nodes, nodes_moves, nodes_transpositions):
+            network_call_results = [next(network_call_results_batch) if transposition is None else None
+                                    for transposition in transpositions]
+            node.expand(moves, network_call_results, transpositions)
+
     def set_fully_expanded(self, minimax_evaluation):
         self.heuristic = minimax_evaluation
         self.expansions = np.inf
         self.fully_expanded = True
 
-    def get_puct_heuristic_for_child(self, i):
-        exploration_term = self.c * np.sqrt(np.log(self.expansions) / (self.children[i].expansions + 1))
-        policy_term = self.d * self.policy[i]
-        return exploration_term + policy_term
+    def get_children_evaluations(self):
+        return self.children_statistics['heuristic']
+
+    def get_children_expansions(self):
+        return self.children_statistics['expansions']
+
+    def select_child(self):
+        fully_expanded = self.children_statistics['fully_expanded']
+        evaluations = self.get_children_evaluations()
+
+        # If a child is already optimal, then this node is fully expanded and there is no point searching further
+        if np.any(fully_expanded & (evaluations == self.optimal_value)):
+            return None, self.optimal_value
 
-    def ensure_children(self, moves=None, network_call_results=None):
+        # if nothing can be chosen because all children are fully expanded
+        if np.all(fully_expanded):
+            return None, self.optimal_value * np.max(self.optimal_value * evaluations)
+
+        # flipping the sign of the evaluations when minimizing allows the best child to always be found with argmax
+        # don't bother exploring fully expanded children
+        combined_heuristics = np.where(fully_expanded, -np.inf,
+                                       self.optimal_value * evaluations + self.get_puct_heuristics())
+        return np.argmax(combined_heuristics), None
+
+    def get_puct_heuristics(self):
+        """
+        :return: A numpy array with the puct heuristic of each child.
+        """
+        # the scalar parts of the exploration terms and the policy terms are only computed once per node
+        exploration_numerator = self.c * math.sqrt(math.log(self.expansions))
+        exploration_terms = exploration_numerator / np.sqrt(self.children_statistics['expansions'] + 1)
+        return exploration_terms + self.children_policy_terms
+
+    def ensure_children(self, moves=None, network_call_results=None, transpositions=None):
+        """
+        :param network_call_results: The network call results for each move. Entries for moves that are found in the
+                                     transposition table are ignored, and may be None.
+        """
         if self.children is None:
-            moves = self.GameClass.get_possible_moves(self.position) if moves is None else moves
-            network_call_results = self.network.call(np.stack(moves, axis=0)) if network_call_results is None \
-                else network_call_results
-            self.children = [HeuristicNode(move, self, self.GameClass, self.network, self.c, self.d,
-                                           network_call_results=network_call_result, verbose=self.verbose)
-                             for move, network_call_result in zip(moves, network_call_results)]
+            moves = self.get_possible_moves() if moves is None else moves
+            transpositions = self.find_transpositions(moves) if transpositions is None else transpositions
+            if network_call_results is None:
+                new_moves = [move for move, transposition in zip(moves, transpositions) if transposition is None]
+                new_network_call_results = iter(self.network.call(np.stack(new_moves, axis=0))
+                                                if len(new_moves) > 0 else [])
+                network_call_results = [next(new_network_call_results) if transposition is None else None
+                                        for transposition in transpositions]
+
+            # children are only created by get_child after their statistics are initialized, so whether they are terminal
+            # is already known
+            def create_child(i, move, statistics):
+                return HeuristicNode(move, self, self.GameClass, self.network, self.c, self.d,
+                                     network_call_results=network_call_results[i], verbose=self.verbose,
+                                     statistics=statistics, transposition_table=self.transposition_table,
+                                     is_over=statistics['fully_expanded'])
+
+            # most children are never visited, so only their statistics are initialized until the search reaches them
+            self.create_children(moves, create_child, transpositions, lazy=True)
+            for i, (move, transposition) in enumerate(zip(moves, transpositions)):
+                if transposition is None:
+                    statistics = self.children_statistics[i]
+                    if self.GameClass.is_over(move):
+                        statistics['heuristic'] = self.GameClass.get_winner(move)
+                        statistics['expansions'] = np.inf
+                        statistics['fully_expanded'] = True
+                    else:
+                        statistics['heuristic'] = network_call_results[i][1]
+            self.children_policy_terms = self.d * np.asarray(self.policy, dtype=np.float32)
+            # the policy is only needed for the policy terms, so don't keep a second copy of it in every expanded node
+            self.policy = None
             self.expansions = 1
@@ -1,25 +1,25 @@
 from time import time
-from multiprocessing import Pool
 import numpy as np
 from perfect_information_game.move_selection import MoveChooser
 from perfect_information_game.move_selection.mcts import RolloutNode
 from perfect_information_game.move_selection.mcts import HeuristicNode
 
 
-# TODO: add hash table to keep track of multiple move combinations that lead to the same position
-
-
 class MCTS(MoveChooser):
     """
     Implementation of Monte Carlo Tree Search
     https://www.youtube.com/watch?v=UXW2yZndl7U
     """
 
-    def __init__(self, GameClass, starting_position=None, network=None, c=np.sqrt(2), d=1, threads=1):
+    def __init__(self, GameClass, starting_position=None, network=None, c=np.sqrt(2), d=1, threads=1,
+                 leaf_batch_size=1, use_transposition_table=True):
         """
         Either:
-        If network is provided, threads must be 1.
+        If network is provided, threads must be 1, and up to leaf_batch_size leaves will be evaluated per network call.
         If network is not provided, then threads will be used for leaf parallelization
+
+        If use_transposition_table is True, then positions that are reached through different move orders will share
+        their statistics.
         """
         super().__init__(GameClass, starting_position)
         if network is not None and threads != 1:
@@ -31,7 +31,9 @@ class MCTS(MoveChooser):
         self.c = c
         self.d = d
         self.threads = threads
-        self.pool = Pool(threads) if threads > 1 else None
+        self.leaf_batch_size = leaf_batch_size
+        self.use_transposition_table = use_transposition_table
+        self.pool = RolloutNode.create_pool(GameClass, threads) if network is None else None
 
     def choose_move(self, return_distribution=False, time_limit=10):
         if return_distribution:
@@ -40,22 +42,21 @@ class MCTS(MoveChooser):
         if self.GameClass.is_over(self.position):
             raise Exception('Game Finished!')
 
+        transposition_table = {} if self.use_transposition_table else None
         if self.network is None:
             root = RolloutNode(self.position, parent=None, GameClass=self.GameClass, c=self.c,
-                               rollout_batch_size=self.threads, pool=self.pool, verbose=True)
+                               rollout_batch_size=self.threads, pool=self.pool, workers=self.threads, verbose=True,
+                               transposition_table=transposition_table)
         else:
-            root = HeuristicNode(self.position, None, self.GameClass, self.network, self.c, self.d, verbose=True)
+            root = HeuristicNode(self.position, None, self.GameClass, self.network, self.c, self.d, verbose=True,
+                                 transposition_table=transposition_table)
 
         start_time = time()
         while time() - start_time < time_limit:
-            best_node = root.choose_expansion_node()
-
-            # best_node will be None if the tree is fully expanded
-            if best_node is None:
+            # expand_best_nodes will return False if the tree is fully expanded
+            if not root.expand_best_nodes(self.leaf_batch_size):
                 break
 
-            best_node.expand()
-
         is_ai_player_1 = self.GameClass.is_player_1_turn(root.position)
         chosen_positions = []
         print(f'MCTS choosing move based on {root.count_expansions()} expansions!')
@@ -63,9 +64,7 @@ class MCTS(MoveChooser):
         # choose moves as long as it is still the ai's turn
         while self.GameClass.is_player_1_turn(root.position) == is_ai_player_1:
             if root.children is None:
-                best_node = root.choose_expansion_node()
-                if best_node is not None:
-                    best_node.expand()
+                root.expand_best_nodes()
             root = root.choose_best_node(optimal=True)
             chosen_positions.append(root.position)
 
@@ -1,12 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
+from numba import njit
 from perfect_information_game.move_selection.mcts import AbstractNode
+from perfect_information_game.utils import get_rng
+
+
+def execute_single_rollout(args):
+    """
+    Plays random moves from the given position until the game is over, and returns the winner.
+    This is defined at the module level (and takes only the position, not the node) so that sending it to a pool
+    doesn't require pickling the node along with all of its parents.
+
+    :param args: A tuple of (position, GameClass).
+    """
+    state, GameClass = args
+    if GameClass.is_over(state):
+        return GameClass.get_winner(state)
+
+    rng = get_rng()
+    moves = None
+    winner = None
+    while winner is None:
+        # step_random checks whether the game is over in the same pass, and may return the next state's moves as well
+        state, moves, winner = GameClass.step_random(state, moves, rng)
+
+    return winner
+
+
+def execute_rollouts(args):
+    """
+    Plays several rollouts in one task, so that a pool only needs to receive the position once and send back one result.
+    The random moves are chosen with get_rng, which already gives every pool worker its own generator.
+
+    :param args: A tuple of (position, GameClass, rollouts).
+    :return: The sum of the winners of the rollouts.
+    """
+    state, GameClass, rollouts = args
+    return sum(execute_single_rollout((state, GameClass)) for _ in range(rollouts))
+
+
+@njit(cache=True, nogil=True)
+def _select_child(children_statistics, rollout_count, c, optimal_value, first_unexplored_index):
+    """
+    Compiled version of AbstractNode.select_child for RolloutNode, which avoids the overhead of about a dozen small
+    numpy calls at every level of every search.
+    Unexplored children are always chosen first and in order, so there is no need to check every child for them.
+
+    :return: A tuple of the index of the chosen child or -1 if the node is fully expanded, the minimax evaluation of
+             the node if it is fully expanded, and the updated first_unexplored_index.
+    """
+    child_count = len(children_statistics)
+    all_fully_expanded = True
+    best_fully_expanded_value = -np.inf
+    for i in range(child_count):
+        if children_statistics[i]['fully_expanded']:
+            # flipping the sign of the evaluations when minimizing allows the best child to always be found with max
+            value = optimal_value * children_statistics[i]['rollout_sum']
+            if value == 1:
+                # a child is already optimal, so there is no point searching further
+                return -1, float(optimal_value), first_unexplored_index
+            best_fully_expanded_value = max(best_fully_expanded_value, value)
+        else:
+            all_fully_expanded = False
+    if all_fully_expanded:
+        return -1, optimal_value * best_fully_expanded_value, first_unexplored_index
+
+    while first_unexplored_index < child_count and children_statistics[first_unexplored_index]['rollout_count'] > 0:
+        first_unexplored_index += 1
+    if first_unexplored_index < child_count:
+        return first_unexplored_index, 0., first_unexplored_index
+
+    # all children have been explored, so none of the rollout counts are 0
+    exploration_numerator = c * np.sqrt(np.log(rollout_count))
+    best_index = -1
+    best_heuristic = -np.inf
+    for i in range(child_count):
+        if not children_statistics[i]['fully_expanded']:
+            rollout_count = children_statistics[i]['rollout_count']
+            heuristic = optimal_value * children_statistics[i]['rollout_sum'] / rollout_count + \
+                exploration_numerator / np.sqrt(rollout_count)
+            if best_index == -1 or heuristic > best_heuristic:
+                best_index = i
+                best_heuristic = heuristic
+    return best_index, 0., first_unexplored_index
 
 
 class RolloutNode(AbstractNode):
-    def __init__(self, position, parent, GameClass, c=np.sqrt(2), rollout_batch_size=1, pool=None, verbose=False):
-        super().__init__(position, parent, GameClass, c, verbose)
+    # float32 halves the size of the statistics, and is exact for the sums and counts of up to 2^24 rollouts
+    # the counts can't be integers because fully expanded nodes have an infinite rollout count
+    STATISTICS_DTYPE = np.dtype([('rollout_sum', np.float32), ('rollout_count', np.float32),
+                                 ('fully_expanded', np.bool_)])
+
+    def __init__(self, position, parent, GameClass, c=np.sqrt(2), rollout_batch_size=1, pool=None, workers=1,
+                 verbose=False, statistics=None, transposition_table=None):
+        """
+        :param pool: The pool used to run the rollouts in parallel, as created by create_pool, or None.
+        :param workers: The number of workers in the pool, which the rollouts are split between.
+        """
+        super().__init__(position, parent, GameClass, c, verbose, statistics, transposition_table)
         self.rollout_batch_size = rollout_batch_size
         self.pool = pool
+        self.workers = workers
+        # all children before this index have been explored
+        self.first_unexplored_index = 0
 
         if self.fully_expanded:
             self.rollout_sum = GameClass.get_winner(position)
@@ -15,44 +113,100 @@ class RolloutNode(AbstractNode):
             self.rollout_sum = 0
             self.rollout_count = 0
 
+    @property
+    def rollout_sum(self):
+        return self.statistics['rollout_sum']
+
+    @rollout_sum.setter
+    def rollout_sum(self, rollout_sum):
+        self.statistics['rollout_sum'] = rollout_sum
+
+    @property
+    def rollout_count(self):
+        return self.statistics['rollout_count']
+
+    @rollout_count.setter
+    def rollout_count(self, rollout_count):
+        self.statistics['rollout_count'] = rollout_count
+
     def count_expansions(self):
         return self.rollout_count
 
     def get_evaluation(self):
         return self.rollout_sum / self.rollout_count if not self.fully_expanded else self.rollout_sum
 
+    def get_children_evaluations(self):
+        rollout_sums = self.children_statistics['rollout_sum']
+        rollout_counts = self.children_statistics['rollout_count']
+        return np.where(self.children_statistics['fully_expanded'], rollout_sums,
+                        rollout_sums / np.maximum(rollout_counts, 1))
+
+    def get_children_expansions(self):
+        return self.children_statistics['rollout_count']
+
     def ensure_children(self):
         if self.children is None:
-            self.children = [RolloutNode(move, self, self.GameClass, self.c, self.rollout_batch_size, self.pool,
-                                         self.verbose)
-                             for move in self.GameClass.get_possible_moves(self.position)]
+            def create_child(i, move, statistics):
+                return RolloutNode(move, self, self.GameClass, self.c, self.rollout_batch_size, self.pool, self.workers,
+                                   self.verbose, statistics, self.transposition_table)
+
+            self.create_children(self.get_possible_moves(), create_child)
 
     def set_fully_expanded(self, minimax_evaluation):
         self.rollout_sum = minimax_evaluation
         self.rollout_count = np.inf
         self.fully_expanded = True
 
-    def get_puct_heuristic_for_child(self, i):
-        exploration_term = self.c * np.sqrt(np.log(self.rollout_count) / self.children[i].rollout_count) \
-            if self.children[i].rollout_count > 0 else np.inf
-        return exploration_term
+    def select_child(self):
+        index, minimax_evaluation, self.first_unexplored_index = _select_child(
+            self.children_statistics, self.rollout_count, self.c, self.optimal_value, self.first_unexplored_index)
+        return (None, minimax_evaluation) if index < 0 else (index, None)
+
+    @staticmethod
+    def create_pool(GameClass, threads):
+        """
+        Rollout kernels that release the GIL can run in parallel on threads, which share the position without pickling
+        it. Rollouts written in python hold the GIL, so they need a process pool instead. Other rollout kernels are
+        already vectorized over the rollouts, so they are run in a single call without a pool.
+
+        :return: A pool with the given number of workers, or None if no pool is needed.
+        """
+        if threads <= 1:
+            return None
+        if GameClass.ROLLOUT_KERNEL is None:
+            return Pool(threads)
+        return ThreadPoolExecutor(threads) if GameClass.ROLLOUT_KERNEL_RELEASES_GIL else None
+
+    def split_rollouts(self, workers):
+        """
+        :return: The number of rollouts for each of the given number of workers to run, so that each worker gets one
+                 task and the rollouts are split as evenly as possible.
+        """
+        chunks = [self.rollout_batch_size // workers + (i < self.rollout_batch_size % workers) for i in range(workers)]
+        return [chunk for chunk in chunks if chunk > 0]
 
     def expand(self):
-        rollout_sum = sum(self.pool.starmap(self.execute_single_rollout, [() for _ in range(self.rollout_batch_size)])
-                          if self.pool is not None else
-                          [self.execute_single_rollout() for _ in range(self.rollout_batch_size)])
+        if self.GameClass.ROLLOUT_KERNEL is not None:
+            if self.pool is not None:
+                rollout_sum = sum(self.pool.map(partial(self.GameClass.ROLLOUT_KERNEL, self.position),
+                                                self.split_rollouts(self.workers)))
+            else:
+                rollout_sum = self.GameClass.ROLLOUT_KERNEL(self.position, self.rollout_batch_size)
+        else:
+            if self.pool is not None:
+                # only the position and the number of rollouts are sent, and only their sum is sent back
+                rollout_args = [(self.position, self.GameClass, rollouts)
+                                for rollouts in self.split_rollouts(self.workers)]
+                rollout_sum = sum(self.pool.imap_unordered(execute_rollouts, rollout_args))
+            else:
+                rollout_sum = execute_rollouts((self.position, self.GameClass, self.rollout_batch_size))
 
         # update this node and all its parents
+        # write to the statistics elements directly, rather than through the properties which look them up again
         node = self
         while node is not None:
-            node.rollout_sum += rollout_sum
-            node.rollout_count += self.rollout_batch_size
+            statistics = node.statistics
+            statistics['rollout_sum'] += rollout_sum
+            statistics['rollout_count'] += self.rollout_batch_size
             node = node.parent
 
-    def execute_single_rollout(self):
-        state = self.position
-        while not self.GameClass.is_over(state):
-            sub_states = self.GameClass.get_possible_moves(state)
-            state = sub_states[np.random.randint(len(sub_states))]
-
-        return self.GameClass.get_winner(state)
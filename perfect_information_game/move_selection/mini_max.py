@@ -4,8 +4,12 @@ from perfect_information_game.move_selection import MoveChooser
 
 class MiniMax(MoveChooser):
     """
-    Implementation of MiniMax with alpha-beta pruning.
+    Implementation of MiniMax with alpha-beta pruning, iterative deepening, and a transposition table.
     """
+    # flags indicating how the value stored in a transposition table entry relates to the true value of the position
+    EXACT, LOWER_BOUND, UPPER_BOUND = range(3)
+    # number of killer moves remembered for each ply
+    KILLER_MOVES = 2
 
     def __init__(self, GameClass, starting_position=None, heuristic_func=None, depth=5):
         """
@@ -18,6 +22,12 @@ class MiniMax(MoveChooser):
         super().__init__(GameClass, starting_position)
         self.heuristic_func = heuristic_func if heuristic_func is not None else GameClass.heuristic
         self.depth = depth
+        # maps the zobrist hash of a position to a tuple of (depth, flag, value, best_move_index)
+        # it is cleared by each call to choose_move, so that it doesn't keep growing with positions that are no longer
+        # reachable, but it is shared between the iterations of iterative deepening
+        self.transposition_table = {}
+        # maps each ply to the keys (see get_move_key) of recent moves that caused a cutoff at that ply
+        self.killer_moves = {}
 
     @staticmethod
     def from_network(GameClass, starting_position=None, network=None, depth=5):
@@ -45,19 +55,19 @@ class MiniMax(MoveChooser):
             raise Exception('Game Finished!')
 
         is_maximizing = self.GameClass.is_player_1_turn(self.position)
-        best_move = None
-        best_heuristic = -np.inf if is_maximizing else np.inf
-        heuristics = []
-
-        for move in self.GameClass.get_possible_moves(self.position):
-            heuristic = self.evaluate_position_recursive(move, self.depth - 1, not is_maximizing, best_heuristic)
-            heuristics.append(heuristic)
+        moves = self.GameClass.get_possible_moves(self.position)
+        heuristics = np.zeros(len(moves))
+        self.transposition_table = {}
+        self.killer_moves = {}
 
-            if (is_maximizing and heuristic > best_heuristic) or (not is_maximizing and heuristic < best_heuristic):
-                best_heuristic = heuristic
-                best_move = move
+        # iterative deepening, so that each search can order its moves using the results of the previous one
+        # an infinite depth search can't be deepened iteratively, so it is done in a single pass
+        best_index = None
+        for depth in (range(1, self.depth + 1) if np.isfinite(self.depth) else [self.depth]):
+            best_index, _ = self.search_moves(self.position, moves, depth, is_maximizing, -np.inf, np.inf, 0,
+                                              best_index, heuristics)
 
-        self.position = best_move
+        self.position = moves[best_index]
 
         if return_distribution:
             # create an exponentially scaled distribution based on the heuristic values
@@ -67,26 +77,110 @@ class MiniMax(MoveChooser):
         else:
             return self.position
 
-    def evaluate_position_recursive(self, position, depth, is_maximizing, value_to_beat):
+    def evaluate_position_recursive(self, position, depth, alpha, beta, ply=1):
+        """
+        :param alpha: The value that the maximizing player is already guaranteed elsewhere in the search.
+        :param beta: The value that the minimizing player is already guaranteed elsewhere in the search.
+        :param ply: The number of moves between the position being searched and the root of the search.
+        :return: The value of the position if it is strictly between alpha and beta. Otherwise, a value that is at least
+                 as bad for the player to move in the parent position as the bound that was crossed.
+        """
         if self.GameClass.is_over(position):
             return self.GameClass.get_winner(position)
 
         if depth == 0:
             return self.heuristic_func(position)
 
-        best_heuristic = -np.inf if is_maximizing else np.inf
-        for child_position in self.GameClass.get_possible_moves(position):
-            heuristic = self.evaluate_position_recursive(child_position, depth - 1, not is_maximizing, best_heuristic)
+        key = self.GameClass.zobrist_hash(position)
+        entry = self.transposition_table.get(key)
+        best_move_index = None
+        if entry is not None:
+            entry_depth, flag, value, best_move_index = entry
+            if entry_depth >= depth:
+                if flag == MiniMax.EXACT:
+                    return value
+                if flag == MiniMax.LOWER_BOUND:
+                    alpha = max(alpha, value)
+                else:
+                    beta = min(beta, value)
+                if alpha >= beta:
+                    return value
+
+        is_maximizing = self.GameClass.is_player_1_turn(position)
+        moves = self.GameClass.get_possible_moves(position)
+        best_index, best_heuristic = self.search_moves(position, moves, depth, is_maximizing, alpha, beta, ply,
+                                                          best_move_index)
+
+        # the search is fail-soft, so a value outside of the window is a bound on the true value
+        if best_heuristic <= alpha:
+            flag = MiniMax.UPPER_BOUND
+        elif best_heuristic >= beta:
+            flag = MiniMax.LOWER_BOUND
+        else:
+            flag = MiniMax.EXACT
+        self.transposition_table[key] = (depth, flag, best_heuristic, best_index)
+        return best_heuristic
 
-            if is_maximizing and heuristic > best_heuristic:
-                if heuristic > value_to_beat:
-                    # prune
-                    return heuristic
-                best_heuristic = heuristic
-            if not is_maximizing and heuristic < best_heuristic:
-                if heuristic < value_to_beat:
-                    # prune
-                    return heuristic
+    def search_moves(self, position, moves, depth, is_maximizing, alpha, beta, ply, best_move_index=None,
+                     heuristics=None):
+        """
+        Evaluates the given moves in order of how likely they are to be best, stopping once alpha-beta pruning shows
+        that the remaining moves don't need to be searched.
+
+        :param position: The position that the moves are made from.
+        :param depth: The depth of the position that the moves are made from.
+        :param best_move_index: The index of the move that was found to be best by a previous search, if any.
+        :param heuristics: If provided, the heuristic of each searched move is stored in this array.
+        :return: A tuple of the index of the best move and its heuristic.
+        """
+        best_index = None
+        best_heuristic = -np.inf if is_maximizing else np.inf
+        for i in self.order_moves(position, moves, ply, best_move_index):
+            heuristic = self.evaluate_position_recursive(moves[i], depth - 1, alpha, beta, ply + 1)
+            if heuristics is not None:
+                heuristics[i] = heuristic
+
+            if best_index is None or (is_maximizing and heuristic > best_heuristic) or \
+                    (not is_maximizing and heuristic < best_heuristic):
+                best_index = i
                 best_heuristic = heuristic
 
-        return best_heuristic
+            if is_maximizing:
+                alpha = max(alpha, heuristic)
+            else:
+                beta = min(beta, heuristic)
+            if alpha >= beta:
+                # prune, and remember the move so that it is tried early in sibling positions
+                killer_moves = self.killer_moves.setdefault(ply, [])
+                move_key = MiniMax.get_move_key(position, moves[i])
+                if move_key not in killer_moves:
+                    killer_moves.insert(0, move_key)
+                    del killer_moves[MiniMax.KILLER_MOVES:]
+                break
+
+        return best_index, best_heuristic
+
+    def order_moves(self, position, moves, ply, best_move_index=None):
+        """
+        :return: The indices of the moves, starting with the best move from the transposition table,
+                 followed by the killer moves for this ply, followed by the remaining moves.
+        """
+        indices = list(range(len(moves)))
+        killer_moves = self.killer_moves.get(ply)
+        if killer_moves:
+            # sorting is stable, so the remaining moves keep their original order
+            indices.sort(key=lambda i: MiniMax.get_move_key(position, moves[i]) not in killer_moves)
+        if best_move_index is not None and best_move_index < len(moves):
+            indices.remove(best_move_index)
+            indices.insert(0, best_move_index)
+        return indices
+
+    @staticmethod
+    def get_move_key(position, move):
+        """
+        Killer moves need to match the same move made from sibling positions, which lead to different resulting
+        positions, so moves are identified by the features that they change rather than by the resulting position.
+
+        :return: The bytes of the flat indices of the features (excluding the turn) that differ between position and move.
+        """
+        return np.flatnonzero(move[..., :-1] != position[..., :-1]).tobytes()
@@ -1,5 +1,5 @@
-from keras.models import load_model
 import tensorflowjs as tfjs
+from perfect_information_game.heuristics import Network
 from perfect_information_game.utils import get_training_path
 from perfect_information_game.games import Chess as GameClass
 import os
@@ -12,8 +12,11 @@ def main():
         output_json = f'{output_folder}/othello_{difficulty}_model.json'
         output_weights_file_name = f'othello_{difficulty}_weights'
 
-        model = load_model(f'{get_training_path(GameClass)}/models/model_{difficulty}.h5')
-        tfjs.converters.save_keras_model(model, output_folder)
+        network = Network(GameClass, f'{get_training_path(GameClass)}/models/model_{difficulty}.h5')
+        network.initialize()
+        # the exported models are only used for inference, so the batch normalization layers can be folded away
+        network.fold_bn()
+        tfjs.converters.save_keras_model(network.model, output_folder)
 
         os.rename(f'{output_folder}/model.json', output_json)
         os.rename(f'{output_folder}/group1-shard1of1.bin', f'{output_folder}/{output_weights_file_name}.bin')
@@ -1,3 +1,5 @@
+import os
+import threading
 import numpy as np
 from itertools import product
 from multiprocessing import Pool
@@ -43,6 +45,32 @@ def choose_random(values):
     return values[np.random.randint(len(values))]
 
 
+_thread_local = threading.local()
+
+
+def get_rng():
+    """
+    np.random.Generator is faster than the legacy np.random functions, but isn't thread safe,
+    so each thread gets its own generator.
+
+    :return: The np.random.Generator for the current thread.
+    """
+    rng = getattr(_thread_local, 'rng', None)
+    if rng is None:
+        rng = _thread_local.rng = np.random.default_rng()
+    return rng
+
+
+def _reset_rngs():
+    # forked processes must not continue their parent's random sequence
+    global _thread_local
+    _thread_local = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_rngs)
+
+
 def one_hot(index, size):
     result = np.zeros(size)
     result[index] = 1
@@ -14,13 +14,14 @@ setup(name='perfect-information-game',
       python_requires='>=3.8',
       install_requires=[
           'numpy',
+          'numba',
           'tensorflow',
           'tensorflowjs',
           'keras',
           'pygame',
           'easygui'
       ],
-      extras_require={'dev': [
+      extras_require={'quantize': ['ai-edge-litert'], 'dev': [
           'chess',
           'memory_profiler',
           'matplotlib',
@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def assert_rollout_kernel_matches_python(test_case, GameClass, state, rollouts=1000):
+    """
+    Checks that GameClass.ROLLOUT_KERNEL plays random games from the given state with the same distribution of outcomes
+    as the python implementation, which plays random moves with step_random.
+    The outcomes are random, so each frequency is only required to be within 4 standard deviations.
+    """
+    rng = np.random.default_rng(0)
+    python_winners = []
+    for _ in range(rollouts):
+        next_state, moves, winner = state, None, None
+        while winner is None:
+            next_state, moves, winner = GameClass.step_random(next_state, moves, rng)
+        python_winners.append(winner)
+        # terminal positions have the same winner for every rollout
+        test_case.assertEqual(GameClass.ROLLOUT_KERNEL(next_state, 3), 3 * winner)
+    kernel_winners = [GameClass.ROLLOUT_KERNEL(state, 1) for _ in range(rollouts)]
+
+    for winner in [-1, 0, 1]:
+        python_frequency = python_winners.count(winner) / rollouts
+        kernel_frequency = kernel_winners.count(winner) / rollouts
+        pooled_frequency = (python_frequency + kernel_frequency) / 2
+        standard_deviation = np.sqrt(2 * pooled_frequency * (1 - pooled_frequency) / rollouts)
+        test_case.assertLessEqual(abs(python_frequency - kernel_frequency), 4 * standard_deviation + 1 / rollouts,
+                                  f'Frequency of winner {winner} differs between the kernel and python rollouts')
@@ -0,0 +1,12 @@
+import unittest
+from perfect_information_game.games import Connect4
+from rollout_kernel_utils import assert_rollout_kernel_matches_python
+
+
+class TestConnect4(unittest.TestCase):
+    def test_rollout_kernel(self):
+        assert_rollout_kernel_matches_python(self, Connect4, Connect4.STARTING_STATE)
+
+
+if __name__ == '__main__':
+    unittest.main()
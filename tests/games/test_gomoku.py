@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+from perfect_information_game.games import Gomoku
+from rollout_kernel_utils import assert_rollout_kernel_matches_python
+
+
+class TestGomoku(unittest.TestCase):
+    def test_batch_step(self):
+        rng = np.random.default_rng(0)
+        state = Gomoku.STARTING_STATE
+        while not Gomoku.is_over(state):
+            next_states, over, winners = Gomoku.batch_step(np.repeat(state[np.newaxis, ...], 3, axis=0), rng)
+            for next_state, next_over, winner in zip(next_states, over, winners):
+                # exactly one piece is placed on an empty square and the turn changes
+                self.assertEqual(np.sum(next_state[..., :2]) - np.sum(state[..., :2]), 1)
+                self.assertEqual(Gomoku.is_player_1_turn(next_state), not Gomoku.is_player_1_turn(state))
+                self.assertEqual(next_over, Gomoku.is_over(next_state))
+                self.assertEqual(winner, Gomoku.get_winner(next_state) if next_over else 0)
+            state = next_states[0]
+
+    def test_rollout_kernel(self):
+        # fill the board with a pattern that has no more than 2 in a row in any direction, except that each player has
+        # 4 in a row with an empty 5th square, so that the outcome depends on who fills the empty squares first
+        i, j = np.indices(Gomoku.BOARD_SHAPE)
+        player_1 = (i // 2 + j) % 2 == 0
+        player_1[0, :4] = True
+        player_1[9, :4] = False
+        state = np.stack([player_1, ~player_1, np.ones(Gomoku.BOARD_SHAPE, dtype=bool)], axis=-1).astype(np.uint8)
+        for square in [(0, 4), (9, 4), (5, 10), (12, 12), (15, 3), (18, 18)]:
+            state[square + (slice(0, 2),)] = 0
+        # python rollouts on the full size board are slow, so fewer are used
+        assert_rollout_kernel_matches_python(self, Gomoku, state, rollouts=300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,12 @@
+import unittest
+from perfect_information_game.games import TicTacToe
+from rollout_kernel_utils import assert_rollout_kernel_matches_python
+
+
+class TestTicTacToe(unittest.TestCase):
+    def test_rollout_kernel(self):
+        assert_rollout_kernel_matches_python(self, TicTacToe, TicTacToe.STARTING_STATE, rollouts=5000)
+
+
+if __name__ == '__main__':
+    unittest.main()
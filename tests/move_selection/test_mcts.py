@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+from perfect_information_game.move_selection.mcts import RolloutNode
+from perfect_information_game.games import TicTacToe as GameClass
+
+
+class TestMCTS(unittest.TestCase):
+    @staticmethod
+    def solve(transposition_table=None):
+        root = RolloutNode(GameClass.STARTING_STATE, None, GameClass, transposition_table=transposition_table)
+        expansions = 0
+        while root.expand_best_nodes():
+            expansions += 1
+        return root, expansions
+
+    def test_transposition_table(self):
+        root, expansions = self.solve()
+        transposition_root, transposition_expansions = self.solve({})
+        self.assertTrue(transposition_root.fully_expanded)
+        self.assertEqual(transposition_root.get_evaluation(), root.get_evaluation())
+        self.assertLess(transposition_expansions, expansions)
+
+        # X in both corners with O in the center is the same position regardless of the order in which X moved
+        transposition = self.play(transposition_root, [(0, 0), (1, 1), (2, 2)])
+        self.assertIs(transposition, self.play(transposition_root, [(2, 2), (1, 1), (0, 0)]))
+
+    @staticmethod
+    def play(node, squares):
+        for i, j in squares:
+            node = next(child for child in node.children if np.any(child.position[i, j, :2] != node.position[i, j, :2]))
+        return node
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import numpy as np
 from perfect_information_game.move_selection import MiniMax
 from perfect_information_game.games import TicTacToe as GameClass
 
@@ -11,6 +12,19 @@ class TestMiniMax(unittest.TestCase):
             raise AssertionError('Tic tac toe solver did not draw the game!')
         print(training_data, outcome)
 
+    def test_repeated_choose_move(self):
+        mini_max = MiniMax.solver(GameClass)
+        mini_max.choose_move()
+
+        # X has 2 in a row on the top row and must complete it, even though the previous search's results are gone
+        position = np.copy(GameClass.STARTING_STATE)
+        position[0, :2, 0] = 1
+        position[1, :2, 1] = 1
+        mini_max.position = position
+        self.assertEqual(mini_max.choose_move()[0, 2, 0], 1)
+        # only positions from the latest search are kept
+        self.assertLess(len(mini_max.transposition_table), 3 ** 5)
+
 
 if __name__ == '__main__':
     unittest.main()